@@ -1,5 +1,5 @@
 from django.contrib import admin
-from models import XFormsSession, DecisionTrigger
+from models import XFormsSession, DecisionTrigger, DailySessionStats, ArchivedSession
 
 class XFormsSessionAdmin(admin.ModelAdmin):
     list_display = ('session_id', 'connection','start_time', 'end_time',
@@ -8,6 +8,17 @@ class XFormsSessionAdmin(admin.ModelAdmin):
 
 admin.site.register(XFormsSession, XFormsSessionAdmin)
 
+class ArchivedSessionAdmin(XFormsSessionAdmin):
+    list_display = XFormsSessionAdmin.list_display + ('archived_time',)
+    date_hierarchy = 'end_time'
+admin.site.register(ArchivedSession, ArchivedSessionAdmin)
+
 class DecisionTriggerAdmin(admin.ModelAdmin):
     list_display = ('xform', 'trigger_keyword')
 admin.site.register(DecisionTrigger, DecisionTriggerAdmin)
+
+class DailySessionStatsAdmin(admin.ModelAdmin):
+    list_display = ('day', 'trigger', 'ended', 'completed', 'cancelled', 'errored')
+    list_filter = ('trigger',)
+    date_hierarchy = 'day'
+admin.site.register(DailySessionStats, DailySessionStatsAdmin)
@@ -1,14 +1,27 @@
 from copy import copy
 from rapidsms.apps.base import AppBase
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, transaction
 from .models import XFormsSession, DecisionTrigger
 from datetime import datetime
-from touchforms.formplayer import api
-from touchforms.formplayer import sms as tfsms
-from smsforms.signals import form_error
+from smsforms.signals import form_error, session_completions
+from smsforms.triggers import trigger_index
+from smsforms.routing import RoutingContext
+from smsforms.sessioncache import session_cache, MISS
+from smsforms.routers import router_factory
+from smsforms.client import touchforms_client
+from smsforms.outbound import outbound_dispatcher, respond
+from smsforms.validators import validator_for, validator_for_question
+from smsforms.metrics import metrics
+from smsforms.locks import connection_lock
+from smsforms.workers import Executor
+from smsforms.reaper import session_reaper
+from smsforms.formdefs import form_definitions
+from smsforms.snapshots import session_snapshots
 import logging
 from touchforms.formplayer.api import XFormsConfig
 from rapidsms.conf import settings
+import threading
 import re
 
 _ = lambda s: s
@@ -17,26 +30,16 @@ _ = lambda s: s
 
 logger = logging.getLogger(__name__)
 
-class SessionRouterCache():
-    """
-    This is pretty ghetto. In order to manage different routers and allow
-    tests to pass we need a global way to get the right router that triggered
-    a message, so use this cache object.
-    """
-    cache = {}
-    
-    def set(self, session_id, router):
-        self.cache[session_id] = router
-        
-    def get(self, session_id):
-        if session_id not in self.cache:
-            raise ValueError("No router value found for session %s" % session_id)
-        return self.cache[session_id]
-
-# see above
-router_factory = SessionRouterCache()
-    
 class TouchFormsApp(AppBase):
+    # pool handling messages in the background, see SMSFORMS_INBOUND_WORKERS
+    _inbound = None
+
+    def __init__(self, router):
+        super(TouchFormsApp, self).__init__(router)
+        # number of messages waiting for (or with) the inbound workers, by
+        # connection id
+        self._queued = {}
+        self._queued_lock = threading.Lock()
         
     # overriding because seeing router|mixin is not helpful 
     @property
@@ -48,6 +51,20 @@ class TouchFormsApp(AppBase):
         return DecisionTrigger.objects.all()
 
     def start(self):
+        router_factory.set_default(self.router)
+        form_definitions.warm()
+        if settings.SMSFORMS_INBOUND_WORKERS:
+            # messages are handled after the router is done with them, so
+            # their responses have to be sent by the outbound workers
+            outbound_dispatcher.start(self.router, max(settings.SMSFORMS_OUTBOUND_WORKERS, 1))
+            self._inbound = Executor(workers=settings.SMSFORMS_INBOUND_WORKERS,
+                                     queue_size=settings.SMSFORMS_INBOUND_QUEUE_SIZE,
+                                     name='smsforms-inbound')
+            self._inbound.start()
+        elif settings.SMSFORMS_OUTBOUND_WORKERS:
+            outbound_dispatcher.start(self.router)
+        if settings.SMSFORMS_REAPER_INTERVAL:
+            session_reaper.start()
         self.info('Started TouchFormsApp')
 
     def get_trigger_keyword(self, msg):
@@ -57,18 +74,21 @@ class TouchFormsApp(AppBase):
         """
         if msg.text.strip():
             first_word = msg.text.lower().strip().split()[0]
-            try:
-                return DecisionTrigger.objects.get(trigger_keyword__iexact=first_word)
-            except ObjectDoesNotExist:
-                return None
+            entry = trigger_index.get(first_word)
+            return entry.trigger if entry else None
 
     def get_session(self, msg):
-        try:
-            session = XFormsSession.objects.get(connection=msg.connection, ended=False)
+        session = session_cache.get(msg.connection.pk)
+        if session is MISS:
+            with metrics.timer('get_session'):
+                try:
+                    session = XFormsSession.objects.get(connection=msg.connection, ended=False)
+                except ObjectDoesNotExist:
+                    session = None
+            session_cache.set(msg.connection.pk, session)
+        if session:
             self.debug('Found existing session! %s' % session)
-            return session
-        except ObjectDoesNotExist:
-            return None
+        return session
 
     def get_recent_session(self, msg):
         try:
@@ -76,6 +96,32 @@ class TouchFormsApp(AppBase):
         except IndexError:
             return None
         
+    def _requested_language(self, contact, trigger):
+        context = trigger_index.entry_for(trigger).context
+        return context.get('_lang') or (contact.language if contact else None)
+
+    def _session_config(self, contact, trigger):
+        """
+        Returns the XFormsConfig to start the trigger's form for contact
+        with, and the new session's select_text_mode.
+        """
+        entry = trigger_index.entry_for(trigger)
+        context = copy(entry.context)
+        # touchforms fails hard if it can't find the language, so pick
+        # one the form has before asking it
+        requested = self._requested_language(contact, trigger)
+        definition = form_definitions.get(entry.form_path)
+        language = definition.resolve_language(requested) if definition else requested
+        # forms without translations are always played as they are, only
+        # count falling back from a translated form
+        if requested and language != requested and definition.languages:
+            logger.debug('Form has no %s translation, using "%s"' % (requested, language))
+            metrics.incr('sessions.language_fallback')
+        config = XFormsConfig(form_path=entry.form_path, 
+                              language=language,
+                              session_data=context)
+        return config, context.get('_select_text_mode')
+
     def _start_session(self, msg, trigger):
         """
         Starts a new touchforms session. Creates the session object in the db
@@ -84,59 +130,56 @@ class TouchFormsApp(AppBase):
         Returns a tuple of the session and the touchforms response to the first
         triggering of the form.
         """
-        form = trigger.xform
-        context = trigger.context
-        language = context.get('_lang') or (msg.contact.language if msg.contact else None)
-        select_text_mode = context.get('_select_text_mode')
+        config, select_text_mode = self._session_config(msg.contact, trigger)
         now = datetime.utcnow()
         
         # start session in touchforms
-        config = XFormsConfig(form_path=form.file.path, 
-                              language=language,
-                              session_data=context)
-        try:
-            session_id, responses = tfsms.start_session(config)
-        except Exception:
-            # this is super ghetto, but currently touchforms fails
-            # hard if it can't find the language. So as a fallback just
-            # try without specifying. If this failed for any other 
-            # reason it will just fail again.
-            config.language = ""
-            session_id, responses = tfsms.start_session(config)
+        session_id, responses = touchforms_client.start_session(config)
         
         # save session in our data models
         session = XFormsSession(start_time=now, modified_time=now, 
                                 session_id=session_id,
                                 connection=msg.connection, ended=False, 
                                 trigger=trigger, select_text_mode=select_text_mode)
-        session.save()
+        try:
+            session.save()
+        except IntegrityError:
+            # another thread or process opened a session for this connection
+            # since we looked (only one may be open, see migration 0012).
+            # The newest trigger wins, as it does in _try_process_as_session_form.
+            transaction.rollback_unless_managed()
+            logger.warn('Concurrent session start for %s, cancelling the other one' % msg.connection)
+            metrics.incr('sessions.conflicts')
+            for other in XFormsSession.objects.filter(connection=msg.connection, ended=False):
+                other.cancel()
+            session.save()
+        metrics.incr('sessions.started')
+        session_cache.set(msg.connection.pk, session)
         router_factory.set(session_id, self.router)
         return session, responses
         
-    def _try_process_as_whole_form(self, msg):
+    def _try_process_as_whole_form(self, msg, ctx=None):
         """
         Try to process this message like an entire submission against an xform.
         
         Returns True if the message matches and was processed.
         """
-        def _match_to_whole_form(msg):
+        def _match_to_whole_form(ctx):
             # for short term, the syntax for whole forms is any message with
             # more than one word in it. First word is taken as keyword and
             # the rest as answers instead of just the keyword (for interactive
             # form entry). This should be smarter, later.
-            text = msg.text.strip()
-            if text:
-                words = text.strip().split()
-                if len(words) > 1:
-                    return self.get_trigger_keyword(msg)
+            if len(ctx.words) > 1:
+                return ctx.trigger
             return None
 
-        def _break_into_answers(msg):
+        def _break_into_answers(ctx):
             # TODO: brittle and not fully featured
             return map(lambda ans: _tf_format(ans)[0],
-                       re.split(settings.ANSWER_DELIMITER_RE, msg.text.strip())[1:])
+                       re.split(settings.ANSWER_DELIMITER_RE, ctx.text)[1:])
 
-        trigger = _match_to_whole_form(msg)
+        ctx = ctx or RoutingContext(self, msg)
+        trigger = _match_to_whole_form(ctx)
         if not trigger:
             return
         
@@ -149,24 +192,69 @@ class TouchFormsApp(AppBase):
         if responses[0].is_error:
             # if the initial session fails, just close the session immediately
             # and return the error
+            _mark_error(session, responses[0].error)
             session.end()
-            msg.respond(responses[0].error)
+            respond(msg, responses[0].error)
             return True
         
-        # loop through answers
         current_question = list(responses)[-1]
-        answers = _break_into_answers(msg)
+        answers = _break_into_answers(ctx)
+
+        # check all the answers we can before sending any of them to touchforms
+        caption, validation_error_msg = self._pre_validate_whole_form(msg, trigger, answers)
+        if validation_error_msg:
+            _mark_error(session, validation_error_msg)
+            return _respond_and_end("%s for \"%s\"" % (validation_error_msg, caption),
+                                    msg, session)
+
+        # loop through answers
+        session_completions.watch(session.session_id)
+        try:
+            return self._submit_answers(msg, session, answers, current_question)
+        finally:
+            session_completions.forget(session.session_id)
+
+    def _pre_validate_whole_form(self, msg, trigger, answers):
+        """
+        Checks the answers of a whole form submission against the questions
+        of the form's definition (see formdefs.py). Forms with logic are
+        left to touchforms, as the questions they ask depend on the answers.
+
+        Returns: caption, error_msg of the first answer that fails
+        """
+        definition = form_definitions.get(trigger_index.entry_for(trigger).form_path)
+        if definition is None or definition.has_logic:
+            return None, None
+        language = definition.resolve_language(self._requested_language(msg.contact, trigger))
+        # info questions are answered along the way, not by the submission
+        questions = [q for q in definition.questions if q.datatype != 'info']
+        with metrics.timer('validate'):
+            for answer, question in zip(answers, questions):
+                answer, error_msg = validator_for_question(question, language).validate(answer)
+                if error_msg:
+                    return question.caption(language), error_msg
+        return None, None
+
+    def _submit_answers(self, msg, session, answers, current_question):
+        """
+        Sends the answers of a whole form submission to touchforms one at a
+        time, then plays through any optional questions left at the end.
+
+        Returns True once the message has been responded to.
+        """
+        responses = [current_question]
         for i, answer in enumerate(answers):
             logging.debug('Processing answer: %s' % answer)
             
             # Attempt to clean and validate given answer before sending to TF
             answer, validation_error_msg = _pre_validate_answer(answer, current_question)
             if validation_error_msg:
+                _mark_error(session, validation_error_msg)
                 return _respond_and_end("%s for \"%s\"" % (validation_error_msg, 
                                                            session.question_to_prompt(current_question)),
                                                            msg, session)
 
-            responses = tfsms.next_responses(session.session_id, answer)
+            responses = touchforms_client.next_responses(session.session_id, answer)
             current_question = list(responses)[-1]               
             
             # get the last touchforms response object so that we can validate our answer
@@ -184,31 +272,47 @@ class TouchFormsApp(AppBase):
 
         # play through the remaining questions at the end of the form
         # and if they are all optional, answer them with blanks and 
-        # finish.
-        session = XFormsSession.objects.get(pk=session.pk)
-        if not session.ended: # and trigger.allow_incomplete:
-            while not session.ended and responses:
-                responses = tfsms.next_responses(session.session_id, "")
+        # finish. (handle_sms_form_complete ends the session and tells
+        # session_completions when the form is done)
+        completed = lambda: session_completions.is_complete(session.session_id)
+        if not completed(): # and trigger.allow_incomplete:
+            while not completed() and responses:
+                responses = touchforms_client.next_responses(session.session_id, "")
                 current_question = list(responses)[-1]               
                 
                 # if any of the remaining items complain about an empty
                 # answer, send the response
                 if _handle_xformresponse_error(current_question, msg, session, self.router):
                     return True
-                
-                session = XFormsSession.objects.get(pk=session.pk)
             
-        session = XFormsSession.objects.get(pk=session.pk)
-        if not session.ended:
-            msg.respond("Incomplete form! The first unanswered question is '%s'." %
-                        session.question_to_prompt(current_question))
+        if not completed():
+            respond(msg, "Incomplete form! The first unanswered question is '%s'." %
+                         session.question_to_prompt(current_question))
             # for now, manually end the session to avoid
             # confusing the session-based engine
+            _mark_error(session, 'Incomplete form')
             session.end()
 
         return True
     
-    def _try_process_as_session_form(self, msg):
+    def _next_responses(self, msg, session, answer):
+        """
+        Sends an answer in an interactive session to touchforms, recording
+        it in the session's snapshot once accepted. If touchforms has lost
+        the session (e.g. it was restarted) the session is rebuilt from
+        the snapshot and the answer sent again. If touchforms just couldn't
+        be reached the error is returned and the session left alone.
+        """
+        responses = touchforms_client.next_responses(session.session_id, answer)
+        if responses[-1].is_error and responses[-1].status == 'http-error' and \
+                touchforms_client.has_session(session.session_id) is False and \
+                session_snapshots.restore(self, msg.contact, session):
+            responses = touchforms_client.next_responses(session.session_id, answer)
+        if not responses[0].is_error:
+            session_snapshots.record(session, answer)
+        return responses
+
+    def _try_process_as_session_form(self, msg, ctx=None):
         """
         Try to process this message like a session-based submission against
         an xform.
@@ -216,19 +320,20 @@ class TouchFormsApp(AppBase):
         Returns True if the message matches and was processed.
         """
         logger.debug('Attempting to process message as SESSION FORM')
+        ctx = ctx or RoutingContext(self, msg)
         # check if this connection is in a form session:
-        session = self.get_session(msg)
-        trigger = self.get_trigger_keyword(msg)
+        session = ctx.session
+        trigger = ctx.trigger
         if not trigger and session is None:
             logger.debug('Not a session form (no session or trigger kw found')
 
             # catch if they reply to the last text from a previous session; we don't
             # want to send them a confusing error message.
-            recent_sess = self.get_recent_session(msg)
             lockout = settings.SMSFORMS_POSTSESSION_LOCKOUT \
                 if hasattr(settings, 'SMSFORMS_POSTSESSION_LOCKOUT') \
                 else None
-            if recent_sess and lockout and datetime.utcnow() < recent_sess.end_time + lockout:
+            recent_sess = ctx.recent_session if lockout else None
+            if recent_sess and datetime.utcnow() < recent_sess.end_time + lockout:
                 # if no other handlers handle this message, it will be swallowed (in the default phase)
                 self.swallow = True
             return False
@@ -236,18 +341,19 @@ class TouchFormsApp(AppBase):
             # mark old session as 'cancelled' and follow process for creating a new one
             logger.debug('Found trigger kw and stale session. Ending old session and starting fresh.')
             session.cancel()
-            session = None
+            session = ctx.session = None
 
         if session:
             logger.debug('Found an existing session, attempting to answer question with message content: %s' % msg.text)
-            last_response = api.current_question(session.session_id)
+            _touch(session)
+            last_response = touchforms_client.current_question(session.session_id)
             ans, error_msg = _pre_validate_answer(msg.text, last_response) 
             # we need the last response to figure out what question type this is.
             if error_msg:
-                msg.respond("%s for \"%s\"" % (error_msg, session.question_to_prompt(last_response)))
+                respond(msg, "%s for \"%s\"" % (error_msg, session.question_to_prompt(last_response)))
                 return True             
             
-            responses = tfsms.next_responses(session.session_id, ans, auth=None)
+            responses = self._next_responses(msg, session, ans)
             
         elif trigger:
             logger.debug('Found trigger keyword. Starting a new session')
@@ -256,15 +362,90 @@ class TouchFormsApp(AppBase):
         else:
             raise Exception("This is not a legal state. Some of our preconditions failed.")
         
-        [msg.respond(session.question_to_prompt(resp)) for resp in responses if resp.text_prompt]
+        [respond(msg, session.question_to_prompt(resp)) for resp in responses if resp.text_prompt]
         logger.debug('Completed processing message as part of SESSION FORM')
         return True
     
     def handle(self, msg):
-        if self._try_process_as_whole_form(msg):
-            return True
-        elif self._try_process_as_session_form(msg):
-            return True
+        if self._inbound is not None:
+            # once a connection has messages queued, all of its messages
+            # join the queue (one of those ahead may be starting a session)
+            # and the worker decides whose they are
+            if msg.connection.pk in self._queued:
+                self.handle_async(msg)
+                return True
+            # nothing of the connection's is in flight, so what we look up
+            # here still holds on the worker
+            ctx = RoutingContext(self, msg)
+            if ctx.trigger or ctx.session:
+                # ours: handle it in the background
+                self.handle_async(msg, ctx)
+                return True
+            return self._handle(msg, ctx)
+        return self._handle(msg)
+
+    def handle_async(self, msg, ctx=None):
+        """
+        Queues msg to be handled by the inbound workers (see
+        SMSFORMS_INBOUND_WORKERS), in order with its connection's other
+        messages, and returns a Future for what handle() would have
+        returned. Messages that turn out not to be ours are passed on to
+        the other apps (see _pass_on). Responses are sent by the outbound
+        workers.
+
+        This only moves the (blocking) handling off the router's thread:
+        each worker still waits on touchforms for the message it is on, so
+        SMSFORMS_INBOUND_WORKERS bounds how many messages are in flight.
+
+        ctx is the message's RoutingContext, if it was already looked up;
+        otherwise the worker looks it up once it has the connection's lock.
+        """
+        if self._inbound is None:
+            raise RuntimeError('handle_async needs SMSFORMS_INBOUND_WORKERS (and start())')
+        with self._queued_lock:
+            self._queued[msg.connection.pk] = self._queued.get(msg.connection.pk, 0) + 1
+        return self._inbound.submit(msg.connection.pk, self._handle_queued, msg, ctx)
+
+    def _handle_queued(self, msg, ctx=None):
+        try:
+            handled = self._handle(msg, ctx)
+            if not handled:
+                self._pass_on(msg)
+            return handled
+        finally:
+            with self._queued_lock:
+                self._queued[msg.connection.pk] -= 1
+                if not self._queued[msg.connection.pk]:
+                    del self._queued[msg.connection.pk]
+
+    def _pass_on(self, msg):
+        """
+        Gives a queued message that wasn't ours to the rest of the router,
+        as it would have had we returned False from handle(): the apps
+        after us get to handle it, then every app to default it.
+        """
+        apps = list(self.router.apps)
+        later = apps[apps.index(self) + 1:] if self in apps else []
+        # the router has long since sent the original's responses
+        msg = copy(msg)
+        msg.responses = []
+        if not any(app.handle(msg) for app in later):
+            any(app.default(msg) for app in apps)
+        for response in msg.responses:
+            if outbound_dispatcher.running:
+                outbound_dispatcher.queue(response)
+            else:
+                self.router.outgoing(response)
+
+    def _handle(self, msg, ctx=None):
+        metrics.incr('messages')
+        with metrics.timer('handle'):
+            with connection_lock(msg.connection.pk):
+                ctx = ctx or RoutingContext(self, msg)
+                if self._try_process_as_whole_form(msg, ctx):
+                    return True
+                elif self._try_process_as_session_form(msg, ctx):
+                    return True
 
     def default(self, msg):
         if getattr(self, 'swallow', False):
@@ -282,44 +463,12 @@ def _pre_validate_answer(text, response):
     Returns: formatted_answer, error_msg
     """
 
-    def _validate_selects(text, response):
-        """
-        Prepares multi/single select answers for TouchForms.
-        """
-        answer_options = re.split(settings.MULTISELECT_DELIMITER_RE, str(text))
-        choices = map(lambda choice: choice.lower(), response.event.choices)
-        logger.debug('Question (%s) answer choices are: %s, given answers: %s' % (datatype, choices, answer_options))
-        new_answers = copy(answer_options)
-        for idx, opt in enumerate(answer_options):
-            logger.debug('Trying to format (m)select answer: "%s"' % opt)
-            try: 
-                #in the case that we accept numbers to indicate option selection
-                opt_int = int(opt)
-                if not (1 <= opt_int <= len(choices)): 
-                    return text, 'Answer %s must be between 1 and %s' % (opt_int, len(choices))
-                else:
-                    new_answers[idx] = str(opt_int)
-
-            except ValueError: 
-                # in the case where we accept the actual text of the question
-                logger.debug('Caught value error, trying to parse answer string choice of: %s' % choices)
-                if opt.lower() not in choices:
-                    return text, 'Answer must be one of the choices'
-                else:
-                    new_answers[idx] = str(choices.index(opt.lower()) + 1)
-        return ' '.join(new_answers), None
-
     if not response:
         return text, 'Must Provide a XformsResponse object for answer validation!'
 
-    datatype = response.event.datatype if response.event else None
-    logger.debug('_pre_validate_answer:: Datatype is "%s"' % datatype)
-    if datatype == 'int':
-        return _tf_format(text,fail_hard=True)
-    elif (datatype == 'select' or datatype == 'multiselect') and len(str(text).strip()): #if length is 0 will drop through to base case.
-        return _validate_selects(text, response)
-    else:
-        return text, None
+    # validators are compiled once per question, see validators.py
+    with metrics.timer('validate'):
+        return validator_for(response).validate(text)
 
 
 def _tf_format(text, fail_hard=False):
@@ -329,6 +478,13 @@ def _tf_format(text, fail_hard=False):
         error_msg = 'Answer must be a number!' if fail_hard else None
         return text, error_msg
 
+def _touch(session):
+    """
+    Records activity on a session, so the reaper leaves it alone.
+    """
+    session.modified_time = datetime.utcnow()
+    XFormsSession.objects.filter(pk=session.pk).update(modified_time=session.modified_time)
+
 def _close_open_sessions(connection):
     sessions = XFormsSession.objects.filter(connection=connection, ended=False)
     map(lambda session: session.end(), sessions)
@@ -338,38 +494,47 @@ def _respond_and_end(text, msg, session):
     # NOTE: We auto trim the text to 160 Chars! SMS Limitations....
     logger.debug('In _respond_and_end()')
     session.end()
-    msg.respond(str(text)[:159])
+    respond(msg, str(text)[:159])
     return True
 
+def _mark_error(session, error_msg):
+    """
+    Flags the session as having hit an error, so it isn't counted as
+    completed when it ends (see stats.py). The caller saves it.
+    """
+    if not session.has_error:
+        metrics.incr('sessions.errored')
+    session.has_error = True
+    session.error_msg = str(error_msg)[:255] #max_length in model
+
 def _handle_xformresponse_error(response, msg, session, router, answer=None):
     """
     Attempts to retrieve whatever partial XForm Instance (raw XML) may exist 
     and posts it to couchforms.
     
-    Also sets the session.error flag (and session.error_msg).
+    Also sets the session.has_error flag (and session.error_msg).
     """
     if not response.is_error:
         return
-    session.error = True
-    session.error_msg = str(response.error)[:255] #max_length in model
+    _mark_error(session, response.error)
     session.save()
     session_id = response.session_id or session.session_id
     if response.status == 'http-error':
         # TODO: translate / customize
         err_resp = _("There was a server error. Please try again later")
         if session_id:
-            partial = api.get_raw_instance(session_id)
+            partial = touchforms_client.get_raw_instance(session_id)
             logger.error('HTTP ERROR. Attempted to get partial XForm instance. Content: %s' % partial)
             if partial:
                 # fire off a the partial using the form-error signal
                 form_error.send(sender="smsforms", session=session,form=unicode(partial).strip(), router=router)
             return _respond_and_end(err_resp, msg, session)
         else:
-            msg.respond(err_resp)
+            respond(msg, err_resp)
             return True
     elif response.status == 'validation-error' and session:
         logger.debug('Handling Validation Error')
-        last_response = api.current_question(session.session_id)
+        last_response = touchforms_client.current_question(session.session_id)
         if last_response.event and last_response.event.text_prompt:
             if answer:
                 ret_msg = '%s:"%s" in "%s"' % (response.error, answer, 
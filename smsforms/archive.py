@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+from django.db import transaction
+from rapidsms.conf import settings
+from smsforms.models import XFormsSession, ArchivedSession
+
+# (XFormsSession field, ArchivedSession attribute) for everything we copy
+FIELDS = [(f.name, f.attname) for f in ArchivedSession._meta.fields if f.name != 'archived_time']
+
+
+def archivable_sessions(days):
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    return XFormsSession.objects.filter(ended=True, end_time__lt=cutoff)
+
+
+@transaction.commit_on_success
+def _move(rows, now):
+    ArchivedSession.objects.bulk_create([
+        ArchivedSession(archived_time=now,
+                        **dict((attname, row[name]) for name, attname in FIELDS))
+        for row in rows])
+    XFormsSession.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+
+
+def archive(days=None, batch_size=None, progress=None):
+    """
+    Moves the sessions that ended more than days (default
+    SMSFORMS_ARCHIVE_AFTER_DAYS) ago from the XFormsSession table to
+    ArchivedSession, batch_size (default SMSFORMS_ARCHIVE_BATCH_SIZE) at a
+    time, each batch in its own transaction.
+
+    Returns the number of sessions archived.
+    """
+    days = days or settings.SMSFORMS_ARCHIVE_AFTER_DAYS
+    batch_size = batch_size or settings.SMSFORMS_ARCHIVE_BATCH_SIZE
+    sessions = archivable_sessions(days).order_by('pk').values(*[name for name, _ in FIELDS])
+    now = datetime.utcnow()
+    count = 0
+    while True:
+        rows = list(sessions[:batch_size])
+        if not rows:
+            return count
+        _move(rows, now)
+        count += len(rows)
+        if progress:
+            progress(count)
+
+
+def all_sessions():
+    """
+    Querysets of the archived and the live sessions, oldest first, for
+    code that reports on every session.
+    """
+    return [ArchivedSession.objects.all(), XFormsSession.objects.all()]
@@ -0,0 +1,259 @@
+"""
+Benchmark harness for the TouchFormsApp: drives TouchFormsApp.handle with
+synthetic traffic against a stand-in touchforms server running in a
+thread, and reports throughput, latency, database queries and touchforms
+calls per message. See the smsformsbench management command.
+"""
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from django.db import connection as db_connection, reset_queries
+from rapidsms.messages.incoming import IncomingMessage
+import threading
+import json
+import itertools
+import time
+
+BENCH_KEYWORD = 'benchsurvey'
+
+# the questions FakeTouchforms asks, matching BENCH_XFORM
+BENCH_QUESTIONS = (
+    {'caption': 'How old are you?', 'datatype': 'int'},
+    {'caption': 'Favourite colour?', 'datatype': 'select', 'choices': ['Red', 'Green', 'Blue']},
+    {'caption': 'Any comments?', 'datatype': 'str'},
+)
+BENCH_ANSWERS = ('42', '2', 'fine')
+
+BENCH_XFORM = """<?xml version="1.0"?>
+<h:html xmlns="http://www.w3.org/2002/xforms" xmlns:h="http://www.w3.org/1999/xhtml">
+  <h:head>
+    <h:title>Benchmark Survey</h:title>
+    <model>
+      <instance>
+        <data xmlns="http://smsforms.bench/survey">
+          <age/>
+          <colour/>
+          <comments/>
+        </data>
+      </instance>
+      <bind nodeset="/data/age" type="int"/>
+      <bind nodeset="/data/colour"/>
+      <bind nodeset="/data/comments" type="string"/>
+    </model>
+  </h:head>
+  <h:body>
+    <input ref="/data/age"><label>How old are you?</label></input>
+    <select1 ref="/data/colour">
+      <label>Favourite colour?</label>
+      <item><label>Red</label><value>red</value></item>
+      <item><label>Green</label><value>green</value></item>
+      <item><label>Blue</label><value>blue</value></item>
+    </select1>
+    <input ref="/data/comments"><label>Any comments?</label></input>
+  </h:body>
+</h:html>
+"""
+
+
+class FakeTouchforms(object):
+    """
+    Plays BENCH_QUESTIONS over the touchforms JSON protocol, from an HTTP
+    server on a background thread, counting the requests it gets.
+    """
+
+    def __init__(self, questions=BENCH_QUESTIONS, host='127.0.0.1', port=0):
+        self.questions = questions
+        self.sessions = {}
+        self.requests = 0
+        # touchforms numbers its sessions
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.touchforms = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%s/' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='smsforms-fake-touchforms')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _event(self, index):
+        if index >= len(self.questions):
+            return {'type': 'form-complete', 'output': '<data/>'}
+        question = self.questions[index]
+        return {'type': 'question', 'ix': str(index), 'required': 0,
+                'caption': question['caption'], 'datatype': question['datatype'],
+                'choices': question.get('choices')}
+
+    def _answer(self, session_id, answer):
+        index, answers = self.sessions[session_id]
+        question = self.questions[index]
+        if question['datatype'] == 'int' and answer not in (None, ''):
+            try:
+                int(answer)
+            except (TypeError, ValueError):
+                return {'status': 'validation-error', 'type': 'constraint',
+                        'reason': 'Answer must be a number'}
+        answers.append(answer)
+        index += 1
+        if index >= len(self.questions):
+            del self.sessions[session_id]
+        else:
+            self.sessions[session_id] = (index, answers)
+        return {'status': 'accepted', 'event': self._event(index)}
+
+    def handle(self, data):
+        action = data.get('action')
+        session_id = data.get('session-id')
+        if isinstance(session_id, basestring):
+            # like touchforms, answers need a numeric session id while
+            # other requests will take it as a string
+            if action in ('answer', 'next') or not session_id.isdigit():
+                return {'status': 'http-error', 'error': 'Bad session id %s' % session_id}
+            session_id = int(session_id)
+        with self._lock:
+            self.requests += 1
+            if action == 'new-form':
+                session_id = next(self._ids)
+                self.sessions[session_id] = (0, [])
+                return {'session_id': session_id, 'event': self._event(0)}
+            if session_id not in self.sessions:
+                return {'status': 'http-error', 'error': 'No session with id %s' % session_id}
+            if action == 'answer':
+                return self._answer(session_id, data.get('answer'))
+            if action == 'next':
+                return self._answer(session_id, None)
+            if action == 'current':
+                return {'event': self._event(self.sessions[session_id][0])}
+            if action == 'get-instance':
+                return {'output': '<data/>'}
+            return {'status': 'http-error', 'error': 'Unknown action %s' % action}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, like touchforms
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        body = json.dumps(self.server.touchforms.handle(data))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# scripts of messages sent by one connection, by kind of traffic
+SCENARIOS = {
+    'interactive': lambda: [BENCH_KEYWORD] + list(BENCH_ANSWERS),
+    'whole-form': lambda: [' '.join((BENCH_KEYWORD,) + BENCH_ANSWERS)],
+    'noise': lambda: ['hello, is anyone there?', 'thanks'],
+    # users who keep re-sending the keyword, restarting the form each time
+    'restart-storm': lambda: [BENCH_KEYWORD, '42', BENCH_KEYWORD, BENCH_KEYWORD] +
+                             list(BENCH_ANSWERS),
+}
+
+
+def traffic(connections_by_scenario, rounds=1):
+    """
+    Yields (scenario, connection, text) for every message, interleaving
+    the connections so that many sessions are open at once.
+    """
+    for _ in range(rounds):
+        scripts = []
+        for scenario, connections in sorted(connections_by_scenario.items()):
+            for connection in connections:
+                scripts.append((scenario, connection, SCENARIOS[scenario]()))
+        step = 0
+        while scripts:
+            remaining = []
+            for scenario, connection, texts in scripts:
+                if step < len(texts):
+                    yield scenario, connection, texts[step]
+                    remaining.append((scenario, connection, texts))
+            scripts = remaining
+            step += 1
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round((len(values) - 1) * p / 100.0))]
+
+
+class Results(object):
+    """
+    Timings (in ms), query counts and touchforms calls of each message.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.queries = 0
+        self.http_calls = 0
+        self.elapsed = 0.0
+
+    def add(self, ms, queries, http_calls):
+        self.latencies.append(ms)
+        self.queries += queries
+        self.http_calls += http_calls
+        self.elapsed += ms / 1000.0
+
+    def summary(self):
+        count = len(self.latencies) or 1
+        return {
+            'messages': len(self.latencies),
+            'msgs_per_sec': len(self.latencies) / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': percentile(self.latencies, 50),
+            'p99_ms': percentile(self.latencies, 99),
+            'queries_per_msg': float(self.queries) / count,
+            'http_per_msg': float(self.http_calls) / count,
+        }
+
+
+def run(app, touchforms, messages):
+    """
+    Hands each (scenario, connection, text) in messages to app.handle,
+    returning a dict of Results by scenario (and 'total').
+
+    Messages are handled right away even with SMSFORMS_INBOUND_WORKERS,
+    so that what is timed is the handling rather than the queueing.
+    """
+    results = {'total': Results()}
+    debug_cursor = db_connection.use_debug_cursor
+    db_connection.use_debug_cursor = True
+    inbound, app._inbound = app._inbound, None
+    try:
+        for scenario, connection, text in messages:
+            msg = IncomingMessage(connection, text)
+            reset_queries()
+            http_calls = touchforms.requests
+            begin = time.time()
+            app.handle(msg)
+            ms = (time.time() - begin) * 1000.0
+            for key in (scenario, 'total'):
+                results.setdefault(key, Results()).add(ms, len(db_connection.queries),
+                                                       touchforms.requests - http_calls)
+    finally:
+        app._inbound = inbound
+        db_connection.use_debug_cursor = debug_cursor
+        reset_queries()
+    return results
@@ -0,0 +1,153 @@
+from datetime import datetime
+from django.db import IntegrityError, transaction
+from rapidsms.conf import settings
+from rapidsms.messages.outgoing import OutgoingMessage
+from smsforms.app import TouchFormsApp
+from smsforms.models import XFormsSession
+from smsforms.client import touchforms_client, async_touchforms_client
+from smsforms.sessioncache import session_cache
+from smsforms.routers import router_factory
+from smsforms.outbound import outbound_dispatcher, RateLimiter
+from smsforms.metrics import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcast(object):
+    """
+    Starts a trigger's form for many connections at once, as if each of
+    them had sent the trigger keyword, and sends them its first question.
+
+    Connections are handled in batches, in primary key order: the
+    touchforms sessions of a batch are started concurrently (on the
+    async touchforms client's bounded pool), their XFormsSessions created
+    with one bulk insert and the first prompts queued for the outbound
+    workers at no more than rate messages a second. Connections already in
+    a session are skipped, so a broadcast that died can safely be run
+    again (see the progress callback of run() for checkpoints).
+
+    The sessions are put in the session cache for the router process to
+    find, so that cache has to be shared (see BaseSessionCache.shared).
+    """
+
+    def __init__(self, trigger, router, rate=None, batch_size=None):
+        self.trigger = trigger
+        self.router = router
+        self.app = TouchFormsApp(router)
+        self.limiter = RateLimiter(settings.SMSFORMS_BROADCAST_RATE if rate is None else rate)
+        self.batch_size = batch_size or settings.SMSFORMS_BROADCAST_BATCH_SIZE
+        self.started = self.skipped = self.failed = 0
+
+    def run(self, connections, progress=None):
+        """
+        Starts the form for every connection in the queryset, calling
+        progress with the highest connection id done once the first
+        questions of each batch are sent.
+        """
+        own_dispatcher = not outbound_dispatcher.running
+        if own_dispatcher:
+            outbound_dispatcher.start(self.router, max(settings.SMSFORMS_OUTBOUND_WORKERS, 1))
+        try:
+            connections = connections.select_related('contact').order_by('pk')
+            last_pk = None
+            while True:
+                batch = connections.filter(pk__gt=last_pk) if last_pk is not None else connections
+                batch = list(batch[:self.batch_size])
+                if not batch:
+                    break
+                self.start_batch(batch)
+                outbound_dispatcher.flush()
+                last_pk = batch[-1].pk
+                if progress:
+                    progress(last_pk)
+        finally:
+            if own_dispatcher:
+                # wait for the prompts still queued to go out
+                outbound_dispatcher.stop()
+
+    def start_batch(self, connections):
+        busy = set(XFormsSession.objects.filter(connection__in=connections, ended=False)
+                   .values_list('connection', flat=True))
+        self.skipped += len(busy)
+
+        pending = []
+        for connection in connections:
+            if connection.pk in busy:
+                continue
+            config, select_text_mode = self.app._session_config(connection.contact, self.trigger)
+            pending.append((connection, select_text_mode,
+                            async_touchforms_client.start_session(config)))
+
+        now = datetime.utcnow()
+        started = []
+        for connection, select_text_mode, future in pending:
+            try:
+                session_id, responses = future.result()
+            except Exception:
+                logger.exception('Error starting a session for %s' % connection)
+                self.failed += 1
+                continue
+            if responses[0].is_error:
+                logger.error('Error starting a session for %s: %s' % (connection, responses[0].error))
+                self.failed += 1
+                continue
+            # as the id will be read back from the database
+            session_id = unicode(session_id)
+            session = XFormsSession(start_time=now, modified_time=now, session_id=session_id,
+                                    connection=connection, ended=False, trigger=self.trigger,
+                                    select_text_mode=select_text_mode)
+            started.append((session, responses))
+        if not started:
+            return
+
+        saved = self._save([session for session, _ in started])
+        for session, responses in started:
+            if session.session_id not in saved:
+                # lost to a session the connection started itself
+                touchforms_client.forget(session.session_id)
+                continue
+            session = saved[session.session_id]
+            session_cache.set(session.connection_id, session)
+            router_factory.set(session.session_id, self.router)
+            for response in responses:
+                if response.text_prompt:
+                    self.send(session.connection, session.question_to_prompt(response))
+        metrics.incr('sessions.started', len(saved))
+        self.started += len(saved)
+
+    def _save(self, sessions):
+        """
+        Inserts the sessions, returning the saved ones by (unicode) session id.
+        """
+        try:
+            XFormsSession.objects.bulk_create(sessions)
+            transaction.commit_unless_managed()
+        except IntegrityError:
+            # someone started a session of their own since we looked (see
+            # migration 0012), insert one at a time and leave them be
+            transaction.rollback_unless_managed()
+            for session in sessions:
+                try:
+                    session.save()
+                    transaction.commit_unless_managed()
+                except IntegrityError:
+                    transaction.rollback_unless_managed()
+                    self.skipped += 1
+        return dict((unicode(session.session_id), session) for session in
+                    XFormsSession.objects.filter(session_id__in=[s.session_id for s in sessions],
+                                                 ended=False).select_related('connection'))
+
+    def send(self, connection, text):
+        self.limiter.wait()
+        outbound_dispatcher.queue(OutgoingMessage(connection, text))
+
+
+def broadcast(trigger, connections, router, rate=None, batch_size=None, progress=None):
+    """
+    Starts trigger's form for the connections (see Broadcast), returning
+    the Broadcast with its started, skipped and failed counts.
+    """
+    job = Broadcast(trigger, router, rate, batch_size)
+    job.run(connections, progress)
+    return job
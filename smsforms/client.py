@@ -0,0 +1,231 @@
+from rapidsms.conf import settings
+from touchforms.formplayer.api import XformsResponse
+from touchforms.formplayer.signals import sms_form_complete
+from smsforms.transport import TransportError, ServerError
+from smsforms.utils import import_class
+from smsforms.lru import LRUCache
+from smsforms.metrics import metrics
+from smsforms.workers import Executor
+from smsforms.walker import local_forms, is_local
+import itertools
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _tf_session_id(session_id):
+    # touchforms session ids are numbers, but we keep them as strings
+    return int(session_id)
+
+
+def _tf_format(answer):
+    # touchforms wants numeric answers (including select choices) as ints
+    try:
+        return int(answer)
+    except (TypeError, ValueError):
+        return answer
+
+
+class TouchformsClient(object):
+    """
+    Talks to the touchforms server on behalf of the TouchFormsApp, through
+    a pluggable transport (see transport.py and
+    SMSFORMS_TOUCHFORMS_TRANSPORT).
+
+    Mirrors the touchforms api and sms modules: start_session and
+    next_responses play through the form to the next question (answering
+    info questions automatically and raising sms_form_complete when the
+    form is done), but return lists rather than generators.
+
+    The question each session was last left on is remembered (in a
+    bounded, process-local cache) so current_question usually doesn't
+    need to ask touchforms.
+
+    With SMSFORMS_LOCAL_FORMS, simple forms are played in-process instead
+    (see walker.py); their sessions never reach touchforms.
+    """
+
+    def __init__(self, transport=None):
+        self._transport = transport
+        self._questions = LRUCache(settings.SMSFORMS_QUESTION_CACHE_SIZE)
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            self._transport = import_class(settings.SMSFORMS_TOUCHFORMS_TRANSPORT)()
+        return self._transport
+
+    def _request(self, data, idempotent=False):
+        with metrics.timer('touchforms.%s' % data.get('action')):
+            return self.transport.request(data, idempotent)
+
+    def _response(self, data, idempotent=False):
+        try:
+            return XformsResponse(self._request(data, idempotent))
+        except TransportError, e:
+            logger.error('%s (action: %s)' % (e, data.get('action')))
+            metrics.incr('touchforms.errors')
+            return XformsResponse.server_down()
+
+    def start_session(self, config):
+        """
+        Returns a tuple of the new session id and the responses to the
+        start of the form.
+        """
+        if settings.SMSFORMS_LOCAL_FORMS and local_forms.can_play(config):
+            return local_forms.start_session(config)
+        response = self._response(config.get_touchforms_dict())
+        # touchforms numbers its sessions, we keep (and store) the ids as strings
+        session_id = str(response.session_id) if response.session_id is not None else None
+        return session_id, self._next(response, session_id)
+
+    def next_responses(self, session_id, answer):
+        if is_local(session_id):
+            return local_forms.next_responses(session_id, answer)
+        if answer:
+            response = self.answer_question(session_id, answer)
+        else:
+            response = self._response({'action': 'next',
+                                       'session-id': _tf_session_id(session_id)})
+        return self._next(response, session_id)
+
+    def answer_question(self, session_id, answer):
+        if is_local(session_id):
+            return local_forms.answer_question(session_id, answer)
+        return self._response({'action': 'answer', 'session-id': _tf_session_id(session_id),
+                               'answer': _tf_format(answer)})
+
+    def current_question(self, session_id):
+        if is_local(session_id):
+            return local_forms.current_question(session_id)
+        response = self._questions.get(str(session_id))
+        if response is None:
+            response = self._response({'action': 'current', 'session-id': session_id},
+                                      idempotent=True)
+            if not response.is_error:
+                self._questions.set(str(session_id), response)
+        return response
+
+    def has_session(self, session_id):
+        """
+        Asks touchforms whether it still has a session, e.g. after a
+        request about it failed. Returns None if touchforms can't be
+        reached (or times out), as it can't tell.
+        """
+        if is_local(session_id):
+            return local_forms.has_session(session_id)
+        try:
+            response = self._request({'action': 'current', 'session-id': _tf_session_id(session_id)},
+                                     idempotent=True)
+        except ServerError:
+            return False
+        except TransportError, e:
+            logger.error('%s (action: current)' % e)
+            metrics.incr('touchforms.errors')
+            return None
+        return not XformsResponse(response).is_error
+
+    def forget(self, session_id):
+        """
+        Drops what we know about a session, once it has ended.
+        """
+        if is_local(session_id):
+            local_forms.forget(session_id)
+        self._questions.discard(str(session_id))
+
+    def purge_stale(self, window):
+        """
+        Asks touchforms to drop every session idle for more than window
+        seconds. Returns whether it could be reached.
+        """
+        try:
+            self._request({'action': 'purge-stale', 'window': window}, idempotent=True)
+            return True
+        except TransportError, e:
+            logger.error('%s (action: purge-stale)' % e)
+            metrics.incr('touchforms.errors')
+            return False
+
+    def get_raw_instance(self, session_id):
+        if is_local(session_id):
+            return local_forms.get_raw_instance(session_id)
+        try:
+            return self._request({'action': 'get-instance', 'session-id': session_id},
+                                 idempotent=True).get('output')
+        except TransportError, e:
+            logger.error('%s (action: get-instance)' % e)
+            metrics.incr('touchforms.errors')
+            return None
+
+    def _next(self, response, session_id):
+        session_id = session_id or response.session_id
+        responses = []
+        while True:
+            responses.append(response)
+            if response.is_error:
+                break
+            elif response.event.type == 'question':
+                if response.event.datatype != 'info':
+                    self._questions.set(str(session_id), response)
+                    break
+                # labels expect an 'ok' before moving on to the next question
+                response = self.answer_question(session_id, 'ok')
+            elif response.event.type == 'form-complete':
+                self.forget(session_id)
+                sms_form_complete.send(sender="touchforms", session_id=session_id,
+                                       form=response.event.output)
+                break
+            else:
+                break
+        return responses
+
+touchforms_client = TouchformsClient()
+
+
+class AsyncTouchformsClient(object):
+    """
+    Non-blocking counterpart of TouchformsClient: each call returns a
+    Future for the TouchformsClient's result right away, and the request
+    is made from a pool of SMSFORMS_TOUCHFORMS_ASYNC_WORKERS threads
+    (started on first use). Calls for the same session run in order.
+
+    It is meant for fanning out many requests at once (broadcasts,
+    prewarming forms). Message handling, on the inbound workers or not,
+    uses the blocking TouchformsClient.
+    """
+
+    def __init__(self, client, executor=None):
+        self.client = client
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._starts = itertools.count()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = Executor(settings.SMSFORMS_TOUCHFORMS_ASYNC_WORKERS,
+                                          settings.SMSFORMS_TOUCHFORMS_ASYNC_QUEUE_SIZE,
+                                          name='smsforms-touchforms')
+            if not self._executor.running:
+                self._executor.start()
+            return self._executor
+
+    def start_session(self, config):
+        # new sessions have no id yet, spread them over the workers
+        return self.executor.submit(next(self._starts), self.client.start_session, config)
+
+    def next_responses(self, session_id, answer):
+        return self.executor.submit(session_id, self.client.next_responses, session_id, answer)
+
+    def answer_question(self, session_id, answer):
+        return self.executor.submit(session_id, self.client.answer_question, session_id, answer)
+
+    def current_question(self, session_id):
+        return self.executor.submit(session_id, self.client.current_question, session_id)
+
+    def get_raw_instance(self, session_id):
+        return self.executor.submit(session_id, self.client.get_raw_instance, session_id)
+
+async_touchforms_client = AsyncTouchformsClient(touchforms_client)
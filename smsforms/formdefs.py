@@ -0,0 +1,304 @@
+from collections import namedtuple
+from xml.etree import ElementTree
+from rapidsms.conf import settings
+import threading
+import hashlib
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+XFORMS = '{http://www.w3.org/2002/xforms}'
+XHTML = '{http://www.w3.org/1999/xhtml}'
+JAVAROSA = '{http://openrosa.org/javarosa}'
+
+# bind types to the datatypes touchforms gives questions
+BIND_DATATYPES = {
+    'int': 'int', 'integer': 'int',
+    'long': 'longint',
+    'decimal': 'float', 'double': 'float', 'float': 'float',
+    'date': 'date', 'time': 'time', 'datetime': 'datetime',
+    'geopoint': 'geo',
+    'barcode': 'barcode',
+}
+# body elements that aren't questions
+NON_CONTROLS = ('label', 'hint', 'help')
+ITEXT_REF = re.compile(r"^\s*jr:itext\(\s*'([^']*)'\s*\)\s*$")
+
+Choice = namedtuple('Choice', ['value', 'labels'])
+
+
+class Question(namedtuple('Question', ['ref', 'datatype', 'labels', 'choices', 'required',
+                                       'relevant', 'constraint', 'constraint_msg', 'group'])):
+    """
+    A question of a form: its instance path, touchforms datatype, label
+    (by language, '' for forms without translations), choices, and the
+    raw XPath of its binds. group is the ref of the group or repeat it is
+    in, if any.
+    """
+
+    def caption(self, language=None):
+        return _translate(self.labels, language)
+
+    def choice_captions(self, language=None):
+        return [_translate(choice.labels, language) for choice in self.choices]
+
+
+def _translate(labels, language):
+    if language in labels:
+        return labels[language]
+    if '' in labels:
+        return labels['']
+    return labels.values()[0] if labels else ''
+
+
+class FormDefinition(object):
+    """
+    What smsforms knows about an XForm without asking touchforms: its
+    title, questions in order, the languages it is translated into and
+    whether it has logic (calculations, skip logic, constraints,
+    preloads, groups, dynamic choices...) that only touchforms can play.
+    instance is the XML of the form's blank instance.
+    """
+
+    def __init__(self, title, questions, languages, default_language, has_logic, instance=None):
+        self.title = title
+        self.questions = questions
+        self.languages = languages
+        self.default_language = default_language
+        self.has_logic = has_logic
+        self.instance = instance
+
+    def __repr__(self):
+        return '<FormDefinition %s: %s questions>' % (self.title, len(self.questions))
+
+    def resolve_language(self, language):
+        """
+        The language touchforms should play the form in for a requested
+        language: the language itself if the form has it, else the form's
+        default ('' for forms without translations).
+        """
+        if language and language in self.languages:
+            return language
+        return self.default_language or ''
+
+
+def _text(element):
+    return (element.text or '').strip() if element is not None else ''
+
+
+def _labels(element, itext):
+    """
+    The label of a control or item, by language.
+    """
+    label = element.find(XFORMS + 'label')
+    if label is None:
+        return {}
+    match = ITEXT_REF.match(label.get('ref') or '')
+    if match:
+        return dict((lang, texts.get(match.group(1), '')) for lang, texts in itext.items())
+    return {'': _text(label)}
+
+
+def _itext(model):
+    """
+    Returns ({lang: {text id: text}}, default lang) for the form's translations.
+    """
+    translations = {}
+    default = None
+    itext = model.find(XFORMS + 'itext') if model is not None else None
+    if itext is None:
+        return translations, default
+    for translation in itext.findall(XFORMS + 'translation'):
+        lang = translation.get('lang')
+        if default is None or translation.get('default') is not None:
+            default = lang
+        texts = translations.setdefault(lang, {})
+        for text in translation.findall(XFORMS + 'text'):
+            value = text.find(XFORMS + 'value')
+            texts[text.get('id')] = _text(value)
+    return translations, default
+
+
+def _binds(model):
+    binds = {}
+    if model is not None:
+        for bind in model.findall(XFORMS + 'bind'):
+            binds[bind.get('nodeset')] = bind
+    return binds
+
+
+def parse(path):
+    """
+    Parses the XForm at path into a FormDefinition.
+    """
+    root = ElementTree.parse(path).getroot()
+    head = root.find(XHTML + 'head')
+    model = head.find(XFORMS + 'model') if head is not None else None
+    itext, default_language = _itext(model)
+    binds = _binds(model)
+    logic = [any(bind.get('relevant') or bind.get('constraint') or bind.get('calculate') or
+                 bind.get(JAVAROSA + 'preload') for bind in binds.values())]
+
+    questions = []
+
+    def walk(parent, group):
+        for element in parent:
+            tag = element.tag.replace(XFORMS, '')
+            if tag in ('group', 'repeat'):
+                logic[0] = True
+                walk(element, element.get('ref') or element.get('nodeset') or group)
+            elif tag in ('input', 'select1', 'select', 'trigger'):
+                if element.find(XFORMS + 'itemset') is not None:
+                    logic[0] = True
+                ref = element.get('ref')
+                bind = binds.get(ref)
+                bind_type = (bind.get('type') or '').split(':')[-1] if bind is not None else ''
+                if tag == 'select1':
+                    datatype = 'select'
+                elif tag == 'select':
+                    datatype = 'multiselect'
+                elif tag == 'trigger':
+                    datatype = 'info'
+                else:
+                    datatype = BIND_DATATYPES.get(bind_type, 'str')
+                choices = [Choice(_text(item.find(XFORMS + 'value')), _labels(item, itext))
+                           for item in element.findall(XFORMS + 'item')]
+                required = bind is not None and (bind.get('required') or '').strip() == 'true()'
+                questions.append(Question(
+                    ref=ref, datatype=datatype, labels=_labels(element, itext),
+                    choices=choices, required=required,
+                    relevant=bind.get('relevant') if bind is not None else None,
+                    constraint=bind.get('constraint') if bind is not None else None,
+                    constraint_msg=bind.get(JAVAROSA + 'constraintMsg') if bind is not None else None,
+                    group=group))
+            elif tag not in NON_CONTROLS:
+                # upload, range, ... only touchforms knows what to do with
+                logic[0] = True
+
+    body = root.find(XHTML + 'body')
+    if body is not None:
+        walk(body, None)
+
+    title = _text(head.find(XHTML + 'title')) if head is not None else ''
+    instance = model.find(XFORMS + 'instance') if model is not None else None
+    if instance is not None and len(instance):
+        instance = ElementTree.tostring(instance[0])
+    else:
+        instance = None
+    return FormDefinition(title, questions, sorted(itext), default_language, logic[0], instance)
+
+
+class FormDefinitionCache(object):
+    """
+    Process-local cache of the parsed definition of each XForm file,
+    re-parsed whenever the file changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._definitions = {}
+
+    def get(self, form_path):
+        """
+        Returns the FormDefinition of the form at form_path, or None if it
+        can't be read or parsed.
+        """
+        try:
+            mtime = os.stat(form_path).st_mtime
+        except OSError:
+            logger.error('Form %s does not exist' % form_path)
+            return None
+        cached = self._definitions.get(form_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        return self._load(form_path, mtime)
+
+    def _load(self, form_path, mtime):
+        try:
+            definition = parse(form_path)
+        except (ElementTree.ParseError, IOError), e:
+            logger.error('Could not parse form %s: %s' % (form_path, e))
+            definition = None
+        with self._lock:
+            self._definitions[form_path] = (mtime, definition)
+        return definition
+
+    def discard(self, form_path):
+        """
+        Drops the definition of the form at form_path, if it's loaded.
+        """
+        with self._lock:
+            self._definitions.pop(form_path, None)
+
+    def clear(self):
+        with self._lock:
+            self._definitions = {}
+
+    def warm(self):
+        """
+        Loads the definition of every form that has a trigger (unless it's
+        already loaded and unchanged). If SMSFORMS_PREWARM_TOUCHFORMS is set
+        touchforms is asked to load the forms that were loaded too.
+        """
+        from smsforms.models import DecisionTrigger
+        form_paths = set(trigger.xform.file.path for trigger in
+                         DecisionTrigger.objects.select_related('xform'))
+        loaded = sum(1 for form_path in form_paths if self.warm_form(form_path))
+        logger.debug('Loaded %s of %s form definitions' % (loaded, len(form_paths)))
+
+    def warm_form(self, form_path):
+        """
+        Loads the definition of the form at form_path, and has touchforms
+        load it too with SMSFORMS_PREWARM_TOUCHFORMS, unless it's already
+        loaded and unchanged. Returns whether it was (re)loaded.
+        """
+        try:
+            mtime = os.stat(form_path).st_mtime
+        except OSError:
+            logger.error('Form %s does not exist' % form_path)
+            return False
+        cached = self._definitions.get(form_path)
+        if cached is not None and cached[0] == mtime:
+            return False
+        if self._load(form_path, mtime) and settings.SMSFORMS_PREWARM_TOUCHFORMS:
+            prewarm_touchforms(form_path, mtime)
+        return True
+
+
+def prewarm_touchforms(form_path, mtime):
+    """
+    Starts a throwaway touchforms session for the form, without waiting
+    for it, so touchforms has parsed the form before the first real one.
+    Each version of a form is only prewarmed once, however many processes
+    start, and its session is forgotten as soon as touchforms has started
+    it (see _end_prewarm_session).
+    Returns the future of the session, or None if it was already prewarmed.
+    """
+    from django.core.cache import cache
+    from touchforms.formplayer.api import XFormsConfig
+    from smsforms.client import async_touchforms_client
+    key = 'smsforms:prewarmed:%s' % hashlib.md5('%s:%s' % (form_path, mtime)).hexdigest()
+    if not cache.add(key, True, settings.SMSFORMS_SESSION_TTL):
+        return None
+    future = async_touchforms_client.start_session(XFormsConfig(form_path=form_path))
+    future.add_done_callback(_end_prewarm_session)
+    return future
+
+
+def _end_prewarm_session(future):
+    """
+    Forgets a prewarm session once it's started. touchforms has no call to
+    end a single session: it drops it with the other idle ones the next
+    time the reaper asks it to purge them.
+    """
+    from smsforms.client import touchforms_client
+    try:
+        session_id, responses = future.result()
+    except Exception:
+        # it failed to start, there's nothing to end
+        return
+    touchforms_client.forget(session_id)
+
+form_definitions = FormDefinitionCache()
@@ -0,0 +1,51 @@
+from contextlib import contextmanager
+from django.db import connection as db_connection
+from rapidsms.conf import settings
+import threading
+
+# first key of the postgres advisory locks we take, so they can't clash
+# with those of other apps ("smsf")
+ADVISORY_LOCK_NAMESPACE = 0x736d7366
+
+
+class StripedLocks(object):
+    """
+    A fixed number of locks shared by any number of keys: work on the same
+    key is serialized, while work on different keys mostly runs in
+    parallel (unless the keys happen to share a stripe).
+    """
+
+    def __init__(self, stripes):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    def lock_for(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+
+connection_locks = StripedLocks(settings.SMSFORMS_LOCK_STRIPES)
+
+
+def _advisory_locks():
+    return settings.SMSFORMS_ADVISORY_LOCKS and \
+        db_connection.settings_dict['ENGINE'].endswith('postgresql_psycopg2')
+
+
+@contextmanager
+def connection_lock(connection_id):
+    """
+    Holds the lock for a connection, so that its messages are handled one
+    at a time. Within a process this is a striped lock; with
+    SMSFORMS_ADVISORY_LOCKS (postgres only) a database advisory lock is
+    also taken so that several router processes can share the work.
+    """
+    with connection_locks.lock_for(connection_id):
+        if not _advisory_locks():
+            yield
+            return
+        cursor = db_connection.cursor()
+        cursor.execute('SELECT pg_advisory_lock(%s, %s)', [ADVISORY_LOCK_NAMESPACE, connection_id])
+        try:
+            yield
+        finally:
+            db_connection.cursor().execute('SELECT pg_advisory_unlock(%s, %s)',
+                                           [ADVISORY_LOCK_NAMESPACE, connection_id])
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+import threading
+import time
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    A thread safe, size bounded dict that evicts the least recently used
+    entries first, and optionally entries older than ttl seconds.
+
+    Keeps hit and miss counts so callers can report on how useful it is.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, stored = self._data.pop(key, (_missing, None))
+            if value is _missing or self._expired(stored):
+                self.misses += 1
+                return default
+            # re-insert to mark as most recently used
+            self._data[key] = (value, stored)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def prune(self):
+        """
+        Drops every expired entry. Expired entries are otherwise only
+        dropped when they are looked up or pushed out by newer ones.
+        """
+        with self._lock:
+            for key, (value, stored) in self._data.items():
+                if self._expired(stored):
+                    del self._data[key]
+
+    def _expired(self, stored):
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,19 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from smsforms.archive import archive
+
+
+class Command(BaseCommand):
+    help = 'Moves sessions that ended a while ago from the live session table to the archive.'
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=None,
+                    help='Archive sessions that ended more than this many days ago '
+                         '(default SMSFORMS_ARCHIVE_AFTER_DAYS)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=None,
+                    help='Sessions moved per transaction (default SMSFORMS_ARCHIVE_BATCH_SIZE)'),
+    )
+
+    def handle(self, **options):
+        count = archive(options['days'], options['batch_size'],
+                        progress=lambda count: self.stdout.write('Archived %s sessions\n' % count))
+        self.stdout.write('Done, %s sessions archived\n' % count)
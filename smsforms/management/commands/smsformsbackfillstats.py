@@ -0,0 +1,64 @@
+from optparse import make_option
+from collections import defaultdict, Counter
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from smsforms.models import DailySessionStats
+from smsforms.archive import all_sessions
+from smsforms import stats
+import datetime
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the daily session stats from the live and archived sessions. '
+            'Existing stats for the days being rebuilt are replaced.')
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', default=None,
+                    help='Only rebuild the stats from this day on (YYYY-MM-DD)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=5000,
+                    help='Number of sessions read at a time (default 5000)'),
+    )
+
+    def handle(self, **options):
+        # nobody sees the stats half rebuilt
+        with transaction.commit_on_success():
+            self.rebuild(options)
+
+    def rebuild(self, options):
+        since = options.get('since')
+        existing = DailySessionStats.objects.all()
+        if since:
+            try:
+                since = datetime.datetime.strptime(since, '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('--since must be given as YYYY-MM-DD')
+            existing = existing.filter(day__gte=since.date())
+        existing.delete()
+
+        self.count = 0
+        for sessions in all_sessions():
+            # errors are counted when their session ends, see stats.ended_counts
+            sessions = sessions.filter(ended=True)
+            if since:
+                sessions = sessions.filter(Q(end_time__gte=since) |
+                                           Q(end_time__isnull=True, start_time__gte=since))
+            self.backfill(sessions.only('trigger', 'start_time', 'end_time', 'modified_time',
+                                        'ended', 'cancelled', 'has_error').order_by('pk'),
+                          options['batch_size'])
+
+    def backfill(self, sessions, batch_size):
+        last_pk = 0
+        while True:
+            batch = list(sessions.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            totals = defaultdict(Counter)
+            for session in batch:
+                # the day record_ended uses
+                day = (session.end_time or datetime.datetime.utcnow()).date()
+                totals[(session.trigger_id, day)].update(stats.ended_counts(session))
+            for (trigger_id, day), counts in totals.items():
+                stats.add(trigger_id, day, counts)
+            last_pk = batch[-1].pk
+            self.count += len(batch)
+            self.stdout.write('Processed %s sessions\n' % self.count)
@@ -0,0 +1,90 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from threadless_router.router import Router
+from rapidsms.models import Backend, Connection
+from touchforms.formplayer.models import XForm
+from smsforms.app import TouchFormsApp
+from smsforms.client import touchforms_client
+from smsforms.models import DecisionTrigger, XFormsSession
+from smsforms.transport import PooledTransport
+from smsforms import bench
+import tempfile
+import os
+
+BENCH_BACKEND = 'smsforms-bench'
+COLUMNS = ('messages', 'msgs_per_sec', 'p50_ms', 'p99_ms', 'queries_per_msg', 'http_per_msg')
+
+
+class Command(BaseCommand):
+    help = ('Drives the TouchFormsApp with synthetic traffic against a local stand-in '
+            'for touchforms and reports throughput, latency, queries and touchforms calls '
+            'per message. Run against a scratch database!')
+    option_list = BaseCommand.option_list + (
+        make_option('--connections', type='int', dest='connections', default=50,
+                    help='Number of connections sending each kind of traffic (default 50)'),
+        make_option('--rounds', type='int', dest='rounds', default=1,
+                    help='Number of times each connection runs through its script (default 1)'),
+        make_option('--scenarios', dest='scenarios', default=','.join(sorted(bench.SCENARIOS)),
+                    help='Comma separated kinds of traffic to send (default: all of %s)'
+                         % ', '.join(sorted(bench.SCENARIOS))),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+                    help="Don't delete the benchmark's data when done"),
+    )
+
+    def handle(self, **options):
+        scenarios = [s.strip() for s in options['scenarios'].split(',') if s.strip()]
+        touchforms = bench.FakeTouchforms()
+        touchforms.start()
+        transport = touchforms_client._transport
+        touchforms_client._transport = PooledTransport(url=touchforms.url)
+        try:
+            trigger = self.setup()
+            connections = self.seed_connections(scenarios, options['connections'])
+            app = TouchFormsApp(Router())
+            app.start()
+            self.stdout.write('Sending traffic: %s\n' % ', '.join(scenarios))
+            results = bench.run(app, touchforms,
+                                bench.traffic(connections, options['rounds']))
+        finally:
+            touchforms_client._transport.close()
+            touchforms_client._transport = transport
+            touchforms.stop()
+        self.report(results)
+        if not options['keep']:
+            self.cleanup(trigger)
+
+    def setup(self):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        try:
+            os.write(fd, bench.BENCH_XFORM)
+            os.close(fd)
+            xform = XForm.from_file(path, 'smsforms benchmark')
+        finally:
+            os.remove(path)
+        return DecisionTrigger.objects.create(xform=xform, trigger_keyword=bench.BENCH_KEYWORD)
+
+    def seed_connections(self, scenarios, count):
+        backend, _ = Backend.objects.get_or_create(name=BENCH_BACKEND)
+        connections = {}
+        for scenario in scenarios:
+            connections[scenario] = [
+                Connection.objects.get_or_create(backend=backend,
+                                                 identity='%s-%s' % (scenario, i))[0]
+                for i in range(count)]
+        return connections
+
+    def report(self, results):
+        self.stdout.write('\n%-15s' % 'traffic' + ''.join('%16s' % c for c in COLUMNS) + '\n')
+        for scenario in sorted(results, key=lambda s: (s == 'total', s)):
+            summary = results[scenario].summary()
+            self.stdout.write('%-15s%16d' % (scenario, summary['messages']) +
+                              ''.join('%16.2f' % summary[c] for c in COLUMNS[1:]) + '\n')
+
+    def cleanup(self, trigger):
+        self.stdout.write('Removing benchmark data\n')
+        XFormsSession.objects.filter(trigger=trigger).delete()
+        xform = trigger.xform
+        trigger.delete()
+        xform.delete()
+        Connection.objects.filter(backend__name=BENCH_BACKEND).delete()
+        Backend.objects.filter(name=BENCH_BACKEND).delete()
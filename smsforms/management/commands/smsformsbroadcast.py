@@ -0,0 +1,63 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from threadless_router.router import Router
+from rapidsms.models import Connection
+from smsforms.models import DecisionTrigger
+from smsforms.broadcast import Broadcast
+from smsforms.sessioncache import session_cache
+import json
+import os
+
+
+class Command(BaseCommand):
+    args = '<trigger keyword>'
+    help = ("Starts a trigger's form for a set of connections and sends them its "
+            "first question, as if they had sent in the keyword.")
+    option_list = BaseCommand.option_list + (
+        make_option('--backend', dest='backend', default=None,
+                    help='Only connections of this backend'),
+        make_option('--identities', dest='identities', default=None,
+                    help='File listing the identities (e.g. phone numbers) to send to, one per line'),
+        make_option('--rate', type='float', dest='rate', default=None,
+                    help='Max messages sent per second (default SMSFORMS_BROADCAST_RATE)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=None,
+                    help='Connections started at a time (default SMSFORMS_BROADCAST_BATCH_SIZE)'),
+        make_option('--resume', dest='resume', default=None,
+                    help='Checkpoint file. Connections done by an earlier run using it are skipped'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the keyword of the trigger to broadcast')
+        if not session_cache.shared:
+            # the router process would never see the sessions started here
+            raise CommandError('SMSFORMS_SESSION_CACHE_BACKEND must be a cache shared '
+                               'with the router process, e.g. DjangoSessionCache')
+        try:
+            trigger = DecisionTrigger.objects.get(trigger_keyword__iexact=args[0])
+        except DecisionTrigger.DoesNotExist:
+            raise CommandError('No trigger with keyword %s' % args[0])
+
+        connections = Connection.objects.all()
+        if options['backend']:
+            connections = connections.filter(backend__name=options['backend'])
+        if options['identities']:
+            with open(options['identities']) as f:
+                identities = [line.strip() for line in f if line.strip()]
+            connections = connections.filter(identity__in=identities)
+        checkpoint = options['resume']
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                connections = connections.filter(pk__gt=json.load(f)['last_pk'])
+
+        def progress(last_pk):
+            if checkpoint:
+                with open(checkpoint, 'w') as f:
+                    json.dump({'last_pk': last_pk}, f)
+            self.stdout.write('Started %s sessions (%s skipped, %s failed)\n' %
+                              (job.started, job.skipped, job.failed))
+
+        job = Broadcast(trigger, Router(), options['rate'], options['batch_size'])
+        job.run(connections, progress)
+        self.stdout.write('Done, %s sessions started (%s skipped, %s failed)\n' %
+                          (job.started, job.skipped, job.failed))
@@ -0,0 +1,128 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from south.db import db
+from rapidsms.models import Backend, Connection
+from smsforms.models import XFormsSession, DecisionTrigger
+from datetime import datetime, timedelta
+import random
+import time
+
+BENCH_BACKEND = 'smsforms-bench'
+SESSION_PREFIX = 'bench-'
+TABLE = XFormsSession._meta.db_table
+# keep in sync with migration 0010
+INDEXES = (
+    ['connection_id', 'ended', 'end_time'],
+    ['session_id', 'ended', 'modified_time'],
+)
+
+
+class Command(BaseCommand):
+    help = ('Seeds historical XFormsSessions and times the hot session lookups '
+            'with and without the composite indexes. Run against a scratch database!')
+    option_list = BaseCommand.option_list + (
+        make_option('--sessions', type='int', dest='sessions', default=2000000,
+                    help='Number of historical sessions to seed (default 2000000)'),
+        make_option('--connections', type='int', dest='connections', default=50000,
+                    help='Number of connections to spread the sessions over (default 50000)'),
+        make_option('--lookups', type='int', dest='lookups', default=500,
+                    help='Number of lookups to time per query (default 500)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=10000,
+                    help='Rows inserted per statement batch (default 10000)'),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+                    help="Don't delete the seeded data when done"),
+    )
+
+    def handle(self, **options):
+        try:
+            trigger = DecisionTrigger.objects.all()[0]
+        except IndexError:
+            raise CommandError('At least one DecisionTrigger is needed to seed sessions against.')
+
+        connection_ids = self.seed_connections(options['connections'])
+        session_ids = self.seed_sessions(trigger, connection_ids, options['sessions'],
+                                         options['batch_size'])
+        with_indexes = self.time_lookups(connection_ids, session_ids, options['lookups'])
+        dropped = []
+        try:
+            for columns in INDEXES:
+                db.delete_index(TABLE, columns)
+                dropped.append(columns)
+            transaction.commit_unless_managed()
+            without_indexes = self.time_lookups(connection_ids, session_ids, options['lookups'])
+        finally:
+            for columns in dropped:
+                db.create_index(TABLE, columns)
+            transaction.commit_unless_managed()
+
+        self.stdout.write('\n%-20s %15s %15s\n' % ('query (ms/lookup)', 'no index', 'indexed'))
+        for name in sorted(with_indexes):
+            self.stdout.write('%-20s %15.3f %15.3f\n' % (name, without_indexes[name],
+                                                         with_indexes[name]))
+        if not options['keep']:
+            self.cleanup()
+
+    def seed_connections(self, count):
+        self.stdout.write('Seeding %s connections\n' % count)
+        backend, _ = Backend.objects.get_or_create(name=BENCH_BACKEND)
+        existing = Connection.objects.filter(backend=backend).count()
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO %s (backend_id, identity) VALUES (%%s, %%s)' % Connection._meta.db_table,
+                           [(backend.pk, 'bench%s' % i) for i in range(existing, count)])
+        transaction.commit_unless_managed()
+        return list(Connection.objects.filter(backend=backend).values_list('pk', flat=True))
+
+    def seed_sessions(self, trigger, connection_ids, count, batch_size):
+        self.stdout.write('Seeding %s sessions\n' % count)
+        cursor = connection.cursor()
+        sql = ('INSERT INTO %s (connection_id, session_id, start_time, modified_time, '
+               'end_time, has_error, ended, trigger_id, cancelled) '
+               'VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)' % TABLE)
+        start = datetime.utcnow() - timedelta(days=365)
+        session_ids = []
+        batch = []
+        for i in xrange(count):
+            started = start + timedelta(seconds=i * 15)
+            # roughly one in fifty sessions is left open
+            ended = i % 50 != 0
+            session_id = '%s%s' % (SESSION_PREFIX, i)
+            batch.append((random.choice(connection_ids), session_id, started, started,
+                          started + timedelta(minutes=5) if ended else None,
+                          False, ended, trigger.pk, False))
+            if i % 1000 == 0:
+                session_ids.append(session_id)
+            if len(batch) >= batch_size:
+                cursor.executemany(sql, batch)
+                transaction.commit_unless_managed()
+                batch = []
+                self.stdout.write('  %s\n' % (i + 1))
+        if batch:
+            cursor.executemany(sql, batch)
+            transaction.commit_unless_managed()
+        return session_ids
+
+    def time_lookups(self, connection_ids, session_ids, count):
+        queries = {
+            'get_session': lambda: list(XFormsSession.objects.filter(
+                connection=random.choice(connection_ids), ended=False)),
+            'get_recent_session': lambda: list(XFormsSession.objects.filter(
+                connection=random.choice(connection_ids), ended=True).order_by('-end_time')[:1]),
+            'form_complete': lambda: list(XFormsSession.objects.filter(
+                session_id=random.choice(session_ids), ended=False).order_by('-modified_time')),
+        }
+        results = {}
+        for name, query in queries.items():
+            begin = time.time()
+            for _ in xrange(count):
+                query()
+            results[name] = (time.time() - begin) * 1000.0 / count
+        return results
+
+    def cleanup(self):
+        self.stdout.write('Removing seeded data\n')
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE session_id LIKE %%s' % TABLE, [SESSION_PREFIX + '%'])
+        Connection.objects.filter(backend__name=BENCH_BACKEND).delete()
+        Backend.objects.filter(name=BENCH_BACKEND).delete()
+        transaction.commit_unless_managed()
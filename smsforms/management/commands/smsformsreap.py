@@ -0,0 +1,18 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from smsforms.reaper import reap
+
+
+class Command(BaseCommand):
+    help = 'Cancels the open sessions nobody has answered for a while.'
+    option_list = BaseCommand.option_list + (
+        make_option('--ttl', type='int', dest='ttl', default=None,
+                    help='Seconds a session can be idle for (default SMSFORMS_SESSION_TTL)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=None,
+                    help='Sessions ended per update (default SMSFORMS_REAPER_BATCH_SIZE)'),
+    )
+
+    def handle(self, **options):
+        count = reap(options['ttl'], options['batch_size'],
+                     progress=lambda count: self.stdout.write('Ended %s sessions\n' % count))
+        self.stdout.write('Done, %s sessions ended\n' % count)
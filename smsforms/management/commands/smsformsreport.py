@@ -1,103 +1,310 @@
-from django.core.management.base import NoArgsCommand
+from optparse import make_option
+from bisect import bisect_left, bisect_right
+from multiprocessing import Pool
+from django.core.management.base import NoArgsCommand, CommandError
 from django.conf import settings
+from django.db import connection
+from django.db.models import Min, Max, Q
 from rapidsms.contrib.messagelog.models import Message
-from smsforms.models import XFormsSession
+from smsforms.models import XFormsSession, ArchivedSession
 import datetime
+import shutil
+import json
+import csv
+import os
 
-DEBUG = True
 DELIMETER = getattr(settings, 'SMSFORMS_REPORT_DELIMETER',',')
 IS_UTCNOW = False
+SESSION_HEADER = ['Session ID', 'Phone Number', 'Form Name', 'Start Time', 'End Time',
+                  'Time To Completion (H:MM:SS)', 'Finished Form?']
+MESSAGE_HEADER = ['', 'Text', 'Date', 'Direction (In/Out)']
+SEPARATOR = ['======================', '======================================================',
+             '=====================================', '================', '================',
+             '================', '================']
+
+
+# sessions whose messages are fetched with one query (each adds a few
+# parameters, and sqlite takes no more than 999)
+MESSAGE_QUERY_SESSIONS = 200
+
+
+def _encode(value):
+    # written the way the report always has, with None as "None"
+    if value is None:
+        return 'None'
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def iter_session_chunks(sessions, chunk_size):
+    """
+    Yields the sessions in lists of up to chunk_size, in primary key order,
+    fetching each chunk with its own (keyset paginated) query so we never
+    hold more than one chunk in memory.
+    """
+    sessions = sessions.select_related('connection', 'trigger__xform').order_by('pk')
+    last_pk = None
+    while True:
+        chunk = sessions.filter(pk__gt=last_pk) if last_pk is not None else sessions
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+class SessionMessages(object):
+    """
+    The messagelog messages for a chunk of sessions, fetched with a few
+    queries that each ask for the messages of many sessions at once (and
+    nothing outside them), that can then be matched up with each session
+    by connection and time.
+    """
+
+    def __init__(self, sessions, hour_delta):
+        self.hour_delta = hour_delta
+        self.by_connection = {}
+        sessions = [s for s in sessions if s.start_time]
+        windows = []
+        for s in sessions:
+            window = Q(connection=s.connection_id, date__gte=s.start_time - hour_delta)
+            if s.end_time:
+                window &= Q(date__lte=s.end_time - hour_delta)
+            windows.append(window)
+        seen = set()
+        for i in range(0, len(windows), MESSAGE_QUERY_SESSIONS):
+            messages = Message.objects.filter(reduce(lambda a, b: a | b,
+                                                     windows[i:i + MESSAGE_QUERY_SESSIONS]))
+            for message in messages:
+                # sessions of a connection may overlap
+                if message.pk not in seen:
+                    seen.add(message.pk)
+                    self.by_connection.setdefault(message.connection_id, []).append(message)
+        for connection_id, messages in self.by_connection.items():
+            messages.sort(key=lambda message: (message.date, message.pk))
+            self.by_connection[connection_id] = ([m.date for m in messages], messages)
+
+    def for_session(self, session):
+        if not session.start_time or session.connection_id not in self.by_connection:
+            return []
+        dates, messages = self.by_connection[session.connection_id]
+        start = bisect_left(dates, session.start_time - self.hour_delta)
+        if session.end_time:
+            end = bisect_right(dates, session.end_time - self.hour_delta)
+        else:
+            end = len(dates)
+        return messages[start:end]
+
+
+def write_session(writer, session, messages, hour_delta):
+    time_to_complete = '-1'
+    if session.ended and session.end_time:
+        time_to_complete = session.end_time - session.start_time
+
+    ###METADATA ROWS###
+    writer.writerow(SESSION_HEADER)
+    writer.writerow(map(_encode, [session.session_id, session.connection.identity,
+                                  session.trigger.xform.name, session.start_time,
+                                  session.end_time, time_to_complete, session.ended]))
+    writer.writerow([])
+
+    ######MESSAGELOG DATA######
+    writer.writerow(MESSAGE_HEADER)
+    for message in messages:
+        writer.writerow(map(_encode, ['', message.text, message.date + hour_delta,
+                                      message.direction]))
+    writer.writerow(SEPARATOR)
+    writer.writerow([])
+
+
+def export_sessions(sessions, f, chunk_size, progress=None):
+    """
+    Writes the report for the sessions queryset to the open file f.
+
+    Returns the highest session id written (or None).
+    """
+    if not IS_UTCNOW:
+        hour_delta = datetime.timedelta(hours=1)
+    else:
+        hour_delta = datetime.timedelta(hours=0)
+    writer = csv.writer(f, delimiter=DELIMETER, lineterminator='\n')
+    last_pk = None
+    for chunk in iter_session_chunks(sessions, chunk_size):
+        messages = SessionMessages(chunk, hour_delta)
+        for session in chunk:
+            write_session(writer, session, messages.for_session(session), hour_delta)
+        last_pk = chunk[-1].pk
+        f.flush()
+        if progress:
+            progress(chunk)
+    return last_pk
+
+
+def filter_sessions(archived=False, since=None, until=None, after_pk=None, start=None, end=None,
+                    no_start=False, modulo=None, remainder=None):
+    """
+    Builds the queryset of (live or archived) sessions to report on from
+    plain values, so the filters for each shard can be handed to another
+    process.
+    """
+    sessions = (ArchivedSession if archived else XFormsSession).objects.all()
+    if since:
+        sessions = sessions.filter(start_time__gte=since)
+    if until:
+        sessions = sessions.filter(start_time__lt=until)
+    if after_pk:
+        sessions = sessions.filter(pk__gt=after_pk)
+    if start:
+        sessions = sessions.filter(start_time__gte=start)
+    if end:
+        sessions = sessions.filter(start_time__lt=end)
+    if no_start:
+        sessions = sessions.filter(start_time__isnull=True)
+    if modulo:
+        sessions = sessions.extra(where=['connection_id %% %s = %s'], params=[modulo, remainder])
+    return sessions
+
+
+def _max_pk(pks):
+    pks = [pk for pk in pks if pk is not None]
+    return max(pks) if pks else None
+
+
+def export_all(filters, f, chunk_size, progress=None):
+    """
+    Writes the report for the archived and then the live sessions matching
+    filters. Archived sessions keep their ids, so the highest id written
+    (which is returned) covers both.
+    """
+    return _max_pk([export_sessions(filter_sessions(archived=archived, **filters),
+                                    f, chunk_size, progress)
+                    for archived in (True, False)])
+
+
+def export_shard(args):
+    """
+    Writes one shard of the report to its own file. Run in a worker process.
+    """
+    filename, filters, chunk_size = args
+    # never share the parent process' database connection
+    connection.close()
+    f = open(filename, 'wb')
+    try:
+        return export_all(filters, f, chunk_size)
+    finally:
+        f.close()
+
+
+def _parse_date(value):
+    if value:
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            raise CommandError('Dates must be given as YYYY-MM-DD, not %s' % value)
+
+
 class Command(NoArgsCommand):
-    help = 'Fetches the latest feed data for active feeds.'
+    help = ('Writes every smsforms session (live and archived), with the messages sent '
+            'during it, to a CSV file.')
     output_filename = 'smsforms_report.csv'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help='Number of sessions fetched (and held in memory) at a time'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write the report to (default %s)' % output_filename),
+        make_option('--since', dest='since', default=None,
+                    help='Only sessions started on or after this date (YYYY-MM-DD)'),
+        make_option('--until', dest='until', default=None,
+                    help='Only sessions started before this date (YYYY-MM-DD)'),
+        make_option('--shards', type='int', dest='shards', default=1,
+                    help='Split the export into this many shards, exported in parallel'),
+        make_option('--shard-by', dest='shard_by', default='time', type='choice',
+                    choices=['time', 'connection'],
+                    help='Shard by ranges of start time (default) or by a hash of the connection'),
+        make_option('--processes', type='int', dest='processes', default=None,
+                    help='Number of processes exporting shards (default: one per CPU)'),
+        make_option('--resume', dest='resume', default=None,
+                    help='Checkpoint file. Only sessions newer than the ones exported by the '
+                         'last run using it are exported, and appended to the output. '
+                         'Sessions that were still open when exported are not exported '
+                         'again once they end'),
+    )
 
-    def output_user(self, session, f):
-        self.stdout.write('Generating data for Session: %s\n' % session)
-        num = session.connection.identity
-        session_id = session.session_id
-        xform_name = session.trigger.xform.name
-        if not IS_UTCNOW:
-            hour_delta = datetime.timedelta(hours=1)
+    def handle_noargs(self, **options):
+        filename = options.get('output') or self.output_filename
+        chunk_size = options.get('chunk_size') or 1000
+        self.verbosity = int(options.get('verbosity', 1))
+        self.count = 0
+        filters = {
+            'since': _parse_date(options.get('since')),
+            'until': _parse_date(options.get('until')),
+        }
+        checkpoint = options.get('resume')
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                filters['after_pk'] = json.load(f)['last_pk']
+            mode = 'ab'
         else:
-            hour_delta = datetime.timedelta(hours=0)
-        time_to_complete = '-1'
-        if session.ended and session.end_time:
-            time_to_complete = session.end_time - session.start_time
-
-        ###MAKE HEADER FOR METADATA ROW###
-        self.stdout.write('(Writing Metadata)')
-        def add_to_row(row, data):
-            """
-            Adds data to row seperating it with the delimeter
-            """
-            return "%s%s%s" % (row, DELIMETER, data)
-        row = 'Session ID'
-        row = add_to_row(row, 'Phone Number')
-        row = add_to_row(row, 'Form Name')
-        row = add_to_row(row, 'Start Time')
-        row = add_to_row(row, 'End Time')
-        row = add_to_row(row, 'Time To Completion (H:MM:SS)')
-        row = add_to_row(row, 'Finished Form?')
-        if DEBUG:
-            self.stdout.write('Writing Metadata row headers to file\n')
-        f.write('%s\n' % row)
-        row = session_id
-        row = add_to_row(row, num)
-        row = add_to_row(row, xform_name)
-        row = add_to_row(row, session.start_time)
-        row = add_to_row(row, session.end_time)
-        row = add_to_row(row, time_to_complete)
-        row = add_to_row(row, session.ended)
-        if DEBUG:
-            self.stdout.write('Writing Metadata data row to file\n')
-        f.write('%s\n' % row)
-
-        ######MAKE MESSAGELOG DATA######
-        self.stdout.write('(Writing Message Data')
-        f.write('\n')
-        if DEBUG:
-            self.stdout.write('Getting Messagelog Messages for %s, start time=%s, end time=%s' % (num, session.start_time, session.end_time))
-        if session.end_time:
-            messages = Message.objects.filter(connection=session.connection, date__range=(session.start_time - hour_delta, session.end_time - hour_delta))
+            mode = 'wb'
+
+        self.stdout.write('\nCreating Report.\nOpening File: %s\n' % filename)
+        if options.get('shards', 1) > 1:
+            last_pk = self.export_shards(filename, mode, filters, chunk_size, options)
         else:
-            messages = Message.objects.filter(connection=session.connection, date__gte=session.start_time - hour_delta)
-        row = add_to_row('', 'Text')
-        row = add_to_row(row, 'Date')
-        row = add_to_row(row, 'Direction (In/Out)')
-        if DEBUG:
-            self.stdout.write('Writing Messages header row to file\n')
-        f.write('%s\n' % row)
-
-        if DEBUG:
-            self.stdout.write('Writing Messages rows to file\n')
-        for message in messages:
-            row = add_to_row('', message.text)
-            mdate = message.date + hour_delta
-            row = add_to_row(row, mdate)
-            row = add_to_row(row, message.direction)
-            f.write('%s\n' % row)
-
-        row = '======================'
-        row = add_to_row(row, '======================================================')
-        row = add_to_row(row, '=====================================')
-        row = add_to_row(row, '================')
-        row = add_to_row(row, '================')
-        row = add_to_row(row, '================')
-        row = add_to_row(row, '================')
-
-        f.write('%s\n' % row)
-        f.write('\n')
-
-        if DEBUG:
-            self.stdout.write('Done Writing Messages header row to file\n')
-            self.stdout.write('Done Writing Session %s to file\n' % session)
+            f = open(filename, mode)
+            try:
+                last_pk = export_all(filters, f, chunk_size, self.progress)
+            finally:
+                f.close()
 
-    def handle_noargs(self, **options):
-        self.stdout.write('\nCreating Report.\nOpening File: %s\n' % self.output_filename)
-        file = open(self.output_filename, 'w')
-        sessions = XFormsSession.objects.all()
-        for session in sessions:
-            self.output_user(session, file)
+        if checkpoint:
+            last_pk = last_pk or filters.get('after_pk')
+            with open(checkpoint, 'w') as f:
+                json.dump({'last_pk': last_pk}, f)
+
+    def progress(self, chunk):
+        if self.verbosity > 1:
+            for session in chunk:
+                self.stdout.write('Generated data for Session: %s\n' % session)
+        self.count += len(chunk)
+        self.stdout.write('Wrote %s sessions\n' % self.count)
+
+    def shard_filters(self, filters, shards, shard_by):
+        if shard_by == 'connection':
+            return [dict(filters, modulo=shards, remainder=i) for i in range(shards)]
+
+        # sessions without a start time fall outside every range, so they
+        # get a shard of their own
+        no_start = dict(filters, no_start=True)
+        bounds = [filter_sessions(archived=archived, **filters).aggregate(
+                      first=Min('start_time'), last=Max('start_time'))
+                  for archived in (True, False)]
+        firsts = [b['first'] for b in bounds if b['first']]
+        if not firsts:
+            return [no_start]
+        first, last = min(firsts), max(b['last'] for b in bounds if b['last'])
+        step = (last - first) / shards + datetime.timedelta(seconds=1)
+        return [dict(filters, start=first + step * i,
+                     end=first + step * (i + 1)) for i in range(shards)] + [no_start]
 
-        file.close()
+    def export_shards(self, filename, mode, filters, chunk_size, options):
+        shards = self.shard_filters(filters, options['shards'], options['shard_by'])
+        jobs = [('%s.part%s' % (filename, i), shard, chunk_size) for i, shard in enumerate(shards)]
+        # the workers are forked, make sure they don't inherit our connection
+        connection.close()
+        pool = Pool(options.get('processes'))
+        try:
+            last_pks = pool.map(export_shard, jobs)
+        finally:
+            pool.close()
+            pool.join()
 
+        self.stdout.write('Merging %s shards\n' % len(jobs))
+        f = open(filename, mode)
+        try:
+            for part, _, _ in jobs:
+                with open(part, 'rb') as part_file:
+                    shutil.copyfileobj(part_file, f)
+                os.remove(part)
+        finally:
+            f.close()
+        return _max_pk(last_pks)
@@ -0,0 +1,129 @@
+from collections import defaultdict
+from rapidsms.conf import settings
+from smsforms.utils import import_class
+import threading
+import logging
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LoggingSink(object):
+    """
+    Logs every metric (at debug level) to the smsforms.metrics logger.
+    """
+
+    def incr(self, name, count):
+        logger.debug('%s +%s' % (name, count))
+
+    def timing(self, name, ms):
+        logger.debug('%s %.2fms' % (name, ms))
+
+
+class StatsdSink(object):
+    """
+    Sends metrics to a statsd server over UDP, fire and forget.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (host or settings.SMSFORMS_STATSD_HOST,
+                        port or settings.SMSFORMS_STATSD_PORT)
+        self.prefix = prefix if prefix is not None else settings.SMSFORMS_STATSD_PREFIX
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, stat):
+        try:
+            self.socket.sendto('%s.%s' % (self.prefix, stat), self.address)
+        except socket.error:
+            pass
+
+    def incr(self, name, count):
+        self._send('%s:%s|c' % (name, count))
+
+    def timing(self, name, ms):
+        self._send('%s:%.3f|ms' % (name, ms))
+
+
+class MemorySink(object):
+    """
+    Keeps every metric in memory, for tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(list)
+
+    def incr(self, name, count):
+        with self._lock:
+            self.counters[name] += count
+
+    def timing(self, name, ms):
+        with self._lock:
+            self.timings[name].append(ms)
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.timing(self.name, (time.time() - self.start) * 1000.0)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_timer = _NullTimer()
+
+
+class Metrics(object):
+    """
+    Counters and timings for the message handling hot path, sent to any
+    number of sinks (see SMSFORMS_METRICS_SINKS). With no sinks every call
+    returns right away.
+    """
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+
+    @property
+    def enabled(self):
+        return bool(self.sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def incr(self, name, count=1):
+        for sink in self.sinks:
+            sink.incr(name, count)
+
+    def timing(self, name, ms):
+        for sink in self.sinks:
+            sink.timing(name, ms)
+
+    def timer(self, name):
+        """
+        Returns a context manager that records how long its block took.
+        """
+        return _Timer(self, name) if self.sinks else _null_timer
+
+metrics = Metrics([import_class(path)() for path in settings.SMSFORMS_METRICS_SINKS])
@@ -1,8 +1,14 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from rapidsms.contrib.messagelog.models import Message
 from rapidsms.models import Connection
 from touchforms.formplayer.models import XForm
 from touchforms.formplayer import api as tfapi
+from smsforms.sessioncache import session_cache
+from smsforms.routers import router_factory
+from smsforms.client import touchforms_client
+from smsforms.metrics import metrics
+from smsforms import stats
 from datetime import datetime
 import json
 
@@ -35,6 +41,11 @@ class DecisionTrigger(models.Model):
 
 
 class XFormsSession(models.Model):
+    # NOTE: the composite indexes on (connection, ended, end_time) and
+    # (session_id, ended, modified_time) that back the hot lookups in the
+    # app are created in migration 0010 (django has no way to declare them).
+    # On postgres, migration 0012 also makes sure each connection has at most
+    # one open session.
     DEFAULT_SELECT_TEXT_MODE = 'vals_only'
 
     connection = models.ForeignKey(Connection, related_name='xform_sessions')
@@ -64,11 +75,17 @@ class XFormsSession(models.Model):
         self.modified_time = now
         self.ended = True
         self.save()
+        session_cache.discard(self.connection_id)
+        router_factory.discard(self.session_id)
+        touchforms_client.forget(self.session_id)
+        stats.record_ended(self)
+        metrics.incr('sessions.ended')
+        if self.cancelled:
+            metrics.incr('sessions.cancelled')
 
     def cancel(self):
-        self.end()
         self.cancelled = True
-        self.save()
+        self.end()
 
     def _select_text_func(self):
         return {
@@ -81,4 +98,85 @@ class XFormsSession(models.Model):
     def question_to_prompt(self, q):
         return q.event.get_text_prompt(self._select_text_func()) \
             if q.event else q.text_prompt
-                
+
+
+class SessionSnapshot(models.Model):
+    """
+    The answers given so far in an interactive session, in order, so its
+    touchforms session can be rebuilt if touchforms loses it (see
+    snapshots.py). Stored as one JSON encoded answer per line and only
+    ever appended to.
+    """
+
+    session = models.OneToOneField(XFormsSession, related_name='snapshot')
+    answers = models.TextField(default='', blank=True)
+
+    def __unicode__(self):
+        return 'Snapshot of %s' % self.session_id
+
+
+class DailySessionStats(models.Model):
+    """
+    How the sessions of a trigger ended on a given day: counts by outcome
+    and a histogram of how long they took. Kept up to date as sessions end
+    (see stats.py) and rebuilt with the smsformsbackfillstats
+    command, so dashboards don't need to scan the session table.
+    """
+
+    trigger = models.ForeignKey(DecisionTrigger, related_name='daily_stats')
+    day = models.DateField(db_index=True)
+    ended = models.PositiveIntegerField(default=0, help_text="Sessions that ended")
+    completed = models.PositiveIntegerField(default=0, help_text="Sessions that ended without being cancelled or hitting an error (including answers turned away)")
+    cancelled = models.PositiveIntegerField(default=0)
+    errored = models.PositiveIntegerField(default=0, help_text="Sessions that ended after hitting an error")
+    total_duration = models.BigIntegerField(default=0, help_text="Total length of the sessions that ended, in seconds")
+    # histogram of session length
+    duration_1m = models.PositiveIntegerField(default=0, help_text="Ended within a minute")
+    duration_5m = models.PositiveIntegerField(default=0, help_text="Ended within 5 minutes")
+    duration_15m = models.PositiveIntegerField(default=0, help_text="Ended within 15 minutes")
+    duration_1h = models.PositiveIntegerField(default=0, help_text="Ended within an hour")
+    duration_1d = models.PositiveIntegerField(default=0, help_text="Ended within a day")
+    duration_over_1d = models.PositiveIntegerField(default=0, help_text="Took more than a day")
+
+    class Meta:
+        unique_together = (('trigger', 'day'),)
+        verbose_name_plural = 'daily session stats'
+
+    def __unicode__(self):
+        return '%s on %s' % (self.trigger, self.day)
+
+
+
+class ArchivedSession(models.Model):
+    """
+    An ended XFormsSession moved out of the live session table once it is
+    older than the retention window (see archive.py), keeping its id so
+    it can be reported on alongside the live sessions.
+    """
+
+    id = models.IntegerField(primary_key=True)
+    connection = models.ForeignKey(Connection, related_name='archived_sessions')
+    session_id = models.CharField(max_length=200, null=True, blank=True)
+    start_time = models.DateTimeField(blank=True, null=True)
+    modified_time = models.DateTimeField(blank=True, null=True)
+    end_time = models.DateTimeField(blank=True, null=True)
+    error_msg = models.CharField(max_length=255, null=True, blank=True)
+    has_error = models.BooleanField(default=False)
+    ended = models.BooleanField(default=True)
+    trigger = models.ForeignKey(DecisionTrigger, related_name='archived_sessions')
+    cancelled = models.BooleanField(default=False)
+    select_text_mode = models.CharField(max_length=50, blank=True, null=True)
+    message_outgoing = models.ForeignKey(Message, blank=True, null=True, related_name='+')
+    message_incoming = models.ForeignKey(Message, blank=True, null=True, related_name='+')
+    archived_time = models.DateTimeField(help_text="When the session was archived")
+
+    def __unicode__(self):
+        return 'Archived Session:: Phone Number:%s, Start Time: %s, End Time: %s' % (self.connection.identity, self.start_time, self.end_time)
+
+
+from smsforms.signals import handle_trigger_changed, handle_session_deleted
+post_save.connect(handle_trigger_changed, sender=DecisionTrigger)
+post_delete.connect(handle_trigger_changed, sender=DecisionTrigger)
+# the index also caches each trigger's form path
+post_save.connect(handle_trigger_changed, sender=XForm)
+post_delete.connect(handle_session_deleted, sender=XFormsSession)
@@ -0,0 +1,112 @@
+from rapidsms.conf import settings
+from rapidsms.messages.outgoing import OutgoingMessage
+from smsforms.workers import KeyedWorkerPool
+from smsforms.metrics import metrics
+import Queue
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundDispatcher(object):
+    """
+    Sends the TouchFormsApp's responses from a pool of worker threads, so
+    that slow backends don't hold up the handling of incoming messages.
+
+    Messages to the same connection are always sent in order, by the same
+    worker. When a worker's queue is full respond() waits for room, so a
+    response can never overtake the ones queued before it.
+    """
+
+    def __init__(self):
+        self.router = None
+        self._pool = None
+
+    @property
+    def running(self):
+        return self._pool is not None and self._pool.running
+
+    def start(self, router, workers=None):
+        self.router = router
+        self._pool = KeyedWorkerPool(self.send,
+                                     workers=workers or settings.SMSFORMS_OUTBOUND_WORKERS,
+                                     queue_size=settings.SMSFORMS_OUTBOUND_QUEUE_SIZE,
+                                     name='smsforms-outbound')
+        self._pool.start()
+
+    def stop(self):
+        if self.running:
+            self._pool.stop()
+
+    def flush(self):
+        """
+        Waits until every message queued so far has been sent.
+        """
+        if self.running:
+            self._pool.join()
+
+    def respond(self, msg, text):
+        """
+        Queues text to be sent in response to msg.
+        """
+        self.queue(OutgoingMessage(msg.connection, text))
+
+    def queue(self, outgoing):
+        """
+        Queues an OutgoingMessage to be sent, waiting for room in its
+        connection's queue for as long as it takes.
+        """
+        try:
+            self._pool.submit(outgoing.connection.pk, outgoing,
+                              timeout=settings.SMSFORMS_OUTBOUND_TIMEOUT)
+        except Queue.Full:
+            logger.warn('Outbound queue full for more than %s seconds, still waiting to send to %s'
+                        % (settings.SMSFORMS_OUTBOUND_TIMEOUT, outgoing.connection))
+            self._pool.submit(outgoing.connection.pk, outgoing)
+
+    def send(self, messages):
+        """
+        Sends messages one at a time, in order.
+        """
+        for outgoing in messages:
+            try:
+                self.router.outgoing(outgoing)
+            except Exception:
+                logger.exception('Error sending message to %s' % outgoing.connection)
+
+outbound_dispatcher = OutboundDispatcher()
+
+
+class RateLimiter(object):
+    """
+    Spaces out callers of wait() to at most rate calls per second (no
+    limit if rate is 0 or None).
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def respond(msg, text):
+    """
+    Responds to msg, through the outbound dispatcher if it's running.
+    """
+    with metrics.timer('respond'):
+        if outbound_dispatcher.running:
+            outbound_dispatcher.respond(msg, text)
+        else:
+            msg.respond(text)
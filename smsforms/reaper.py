@@ -0,0 +1,124 @@
+from datetime import datetime, timedelta
+from django.db import connection, transaction
+from django.db.models import Q
+from rapidsms.conf import settings
+from smsforms.models import XFormsSession
+from smsforms.sessioncache import session_cache
+from smsforms.routers import router_factory
+from smsforms.client import touchforms_client
+from smsforms.metrics import metrics
+from smsforms import stats
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def stale_sessions(ttl, now=None):
+    """
+    The open sessions nobody has touched for more than ttl seconds.
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=ttl)
+    return XFormsSession.objects.filter(
+        Q(modified_time__lt=cutoff) | Q(modified_time__isnull=True, start_time__lt=cutoff),
+        ended=False)
+
+
+def reap(ttl=None, batch_size=None, progress=None):
+    """
+    Cancels the sessions idle for more than ttl seconds (default
+    SMSFORMS_SESSION_TTL), batch_size (default SMSFORMS_REAPER_BATCH_SIZE)
+    at a time, with one UPDATE per batch rather than XFormsSession.end()
+    per session. Caches and stats are updated in bulk, for the sessions
+    this run actually ended (not those answered since they were picked, or
+    ended by someone else), and touchforms is asked once to drop its stale
+    sessions.
+
+    Returns the number of sessions ended.
+    """
+    ttl = ttl or settings.SMSFORMS_SESSION_TTL
+    batch_size = batch_size or settings.SMSFORMS_REAPER_BATCH_SIZE
+    now = datetime.utcnow()
+    sessions = stale_sessions(ttl, now).only('connection', 'session_id', 'trigger', 'start_time',
+                                             'has_error').order_by('pk')
+    count = 0
+    while True:
+        batch = list(sessions[:batch_size])
+        if not batch:
+            break
+        pks = [s.pk for s in batch]
+        # check they are still stale, they may have been answered since
+        if stale_sessions(ttl, now).filter(pk__in=pks) \
+                .update(ended=True, cancelled=True, end_time=now, modified_time=now):
+            transaction.commit_unless_managed()
+            # the ones this run ended are those ended at now
+            reaped = set(XFormsSession.objects.filter(pk__in=pks, ended=True, end_time=now)
+                         .values_list('pk', flat=True))
+        else:
+            reaped = set()
+        batch = [s for s in batch if s.pk in reaped]
+
+        for session in batch:
+            session.ended = session.cancelled = True
+            session.end_time = session.modified_time = now
+            router_factory.discard(session.session_id)
+            touchforms_client.forget(session.session_id)
+        session_cache.discard_many(set(s.connection_id for s in batch))
+        stats.record_ended_many(batch)
+
+        count += len(batch)
+        if progress:
+            progress(count)
+
+    # also drops the sessions touchforms still has for ended sessions
+    # and prewarmed forms, which it can't be asked to end one by one
+    touchforms_client.purge_stale(ttl)
+    if count:
+        metrics.incr('sessions.reaped', count)
+    logger.info('Reaped %s sessions idle for more than %s seconds' % (count, ttl))
+    return count
+
+
+class SessionReaper(object):
+    """
+    Runs reap() every SMSFORMS_REAPER_INTERVAL seconds on a timer thread.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or settings.SMSFORMS_REAPER_INTERVAL
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._timer is not None
+
+    def start(self):
+        with self._lock:
+            if self._timer is None:
+                self._schedule()
+
+    def stop(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _schedule(self):
+        self._timer = threading.Timer(self.interval, self._run)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _run(self):
+        try:
+            reap()
+        except Exception:
+            logger.exception('Error reaping stale sessions')
+        finally:
+            # don't hold on to this thread's database connection
+            connection.close()
+        with self._lock:
+            if self._timer is not None:
+                self._schedule()
+
+session_reaper = SessionReaper()
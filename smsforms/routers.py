@@ -0,0 +1,66 @@
+from rapidsms.conf import settings
+from smsforms.lru import LRUCache
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SessionRouterRegistry(object):
+    """
+    In order to manage different routers and allow tests to pass we need a
+    global way to get the right router that triggered a message.
+
+    Routers are kept per session id, bounded in number and age, and dropped
+    as soon as their session ends. Lookups for sessions we no longer know
+    about get the default router (that of the running TouchFormsApp).
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self._routers = LRUCache(max_size or settings.SMSFORMS_ROUTER_REGISTRY_SIZE,
+                                 ttl or settings.SMSFORMS_ROUTER_REGISTRY_TTL)
+        self._last_prune = time.time()
+        self.default = None
+        self.fallbacks = 0
+
+    def set_default(self, router):
+        self.default = router
+
+    def set(self, session_id, router):
+        self._routers.set(session_id, router)
+        if time.time() - self._last_prune > 60:
+            self._routers.prune()
+            self._last_prune = time.time()
+
+    def get(self, session_id):
+        router = self._routers.get(session_id)
+        if router is not None:
+            return router
+        if self.default is None:
+            raise ValueError("No router value found for session %s" % session_id)
+        logger.debug('No router found for session %s, using the default' % session_id)
+        self.fallbacks += 1
+        return self.default
+
+    def discard(self, session_id):
+        self._routers.discard(session_id)
+
+    @property
+    def size(self):
+        return len(self._routers)
+
+    @property
+    def hit_rate(self):
+        return self._routers.hit_rate
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'hits': self._routers.hits,
+            'misses': self._routers.misses,
+            'hit_rate': self.hit_rate,
+            'fallbacks': self.fallbacks,
+        }
+
+# see above
+router_factory = SessionRouterRegistry()
@@ -0,0 +1,43 @@
+_unset = object()
+
+
+class RoutingContext(object):
+    """
+    Per-message routing state for the TouchFormsApp.
+
+    The message text is tokenized once and the trigger, open session and
+    most recently ended session are each looked up at most once, the first
+    time a handler asks for them, so that the whole form and session form
+    handlers can share the same lookups.
+    """
+
+    def __init__(self, app, msg):
+        self.app = app
+        self.msg = msg
+        self.text = msg.text.strip()
+        self.words = self.text.split()
+        self._trigger = _unset
+        self._session = _unset
+        self._recent_session = _unset
+
+    @property
+    def trigger(self):
+        if self._trigger is _unset:
+            self._trigger = self.app.get_trigger_keyword(self.msg) if self.words else None
+        return self._trigger
+
+    @property
+    def session(self):
+        if self._session is _unset:
+            self._session = self.app.get_session(self.msg)
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    @property
+    def recent_session(self):
+        if self._recent_session is _unset:
+            self._recent_session = self.app.get_recent_session(self.msg)
+        return self._recent_session
@@ -0,0 +1,113 @@
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.dummy import DummyCache
+from rapidsms.conf import settings
+from smsforms.lru import LRUCache
+from smsforms.utils import import_class
+
+# returned by get() when the cache knows nothing about a connection
+MISS = object()
+# stored in place of a session for connections known to have no open session
+NO_SESSION = 'smsforms:no-session'
+
+
+class BaseSessionCache(object):
+    """
+    Caches the open XFormsSession (or the lack of one) for each connection
+    id, so that the bulk of incoming messages, which don't belong to any
+    form, never have to touch the session table.
+
+    Subclasses implement _get, _set, discard and clear (and discard_many,
+    if they can do better than discarding one connection at a time), and
+    set shared if every process sees the same cache.
+    """
+    shared = False
+
+    def get(self, connection_id):
+        """
+        Returns the cached open session for the connection, None if the
+        connection is known to have no open session, or MISS.
+        """
+        value = self._get(connection_id)
+        if value is None:
+            return MISS
+        return None if value == NO_SESSION else value
+
+    def set(self, connection_id, session):
+        """
+        Caches the open session for a connection. Pass None to record that
+        the connection has no open session.
+        """
+        if session is None:
+            # a process-local cache can't hear about sessions started
+            # elsewhere (e.g. by smsformsbroadcast), so don't let it
+            # vouch for their absence
+            if self.shared and settings.SMSFORMS_SESSION_CACHE_NEGATIVE:
+                self._set(connection_id, NO_SESSION)
+        else:
+            self._set(connection_id, session)
+
+    def discard_many(self, connection_ids):
+        for connection_id in connection_ids:
+            self.discard(connection_id)
+
+
+class LocalSessionCache(BaseSessionCache):
+    """
+    Process-local session cache with LRU eviction. Only safe when a single
+    process starts and ends sessions. Connections without a session are
+    never cached.
+    """
+
+    def __init__(self):
+        self._cache = LRUCache(settings.SMSFORMS_SESSION_CACHE_SIZE)
+
+    def _get(self, connection_id):
+        return self._cache.get(connection_id)
+
+    def _set(self, connection_id, value):
+        self._cache.set(connection_id, value)
+
+    def discard(self, connection_id):
+        self._cache.discard(connection_id)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class DjangoSessionCache(BaseSessionCache):
+    """
+    Session cache backed by django's cache framework, to share the cache
+    between router processes and management commands. That takes a cache
+    backend every process sees (e.g. memcached): with django's default
+    (locmem, per process) or the dummy cache it isn't shared.
+    """
+    key_prefix = 'smsforms:session:'
+
+    def __init__(self):
+        self.shared = not isinstance(cache, (LocMemCache, DummyCache))
+        # bumped by clear(), as the django cache can't drop just our keys
+        self._generation = 0
+
+    def _key(self, connection_id):
+        return '%s%s:%s' % (self.key_prefix, self._generation, connection_id)
+
+    def _get(self, connection_id):
+        return cache.get(self._key(connection_id))
+
+    def _set(self, connection_id, value):
+        cache.set(self._key(connection_id), value, settings.SMSFORMS_SESSION_CACHE_TIMEOUT)
+
+    def discard(self, connection_id):
+        cache.delete(self._key(connection_id))
+
+    def discard_many(self, connection_ids):
+        cache.delete_many([self._key(connection_id) for connection_id in connection_ids])
+
+    def clear(self):
+        # our entries so far are left to expire, the rest of the cache
+        # (e.g. the trigger index's version) is untouched
+        self._generation += 1
+
+
+session_cache = import_class(settings.SMSFORMS_SESSION_CACHE_BACKEND)()
@@ -2,4 +2,103 @@
 # spaces
 ANSWER_DELIMITER_RE = " "
 # pipes, dots or commas
-MULTISELECT_DELIMITER_RE = "\||\.|,"
\ No newline at end of file
+MULTISELECT_DELIMITER_RE = "\||\.|,"
+
+# cache of the open session (if any) for each connection, see sessioncache.py.
+# The default shares it between router processes and management commands
+# through django's cache, if that is shared (e.g. memcached, not locmem);
+# smsforms.sessioncache.LocalSessionCache is only safe when a single
+# process ever creates or ends sessions.
+SMSFORMS_SESSION_CACHE_BACKEND = 'smsforms.sessioncache.DjangoSessionCache'
+# max connections kept by the local backend
+SMSFORMS_SESSION_CACHE_SIZE = 10000
+# seconds entries are kept by the django backend
+SMSFORMS_SESSION_CACHE_TIMEOUT = 60 * 60
+# also remember connections that have no open session (shared backends only)
+SMSFORMS_SESSION_CACHE_NEGATIVE = True
+
+# max number of session routers kept around, see routers.py
+SMSFORMS_ROUTER_REGISTRY_SIZE = 10000
+# seconds after which a session's router is forgotten
+SMSFORMS_ROUTER_REGISTRY_TTL = 60 * 60 * 24
+
+# how we talk to touchforms (at XFORMS_PLAYER_URL), see transport.py
+SMSFORMS_TOUCHFORMS_TRANSPORT = 'smsforms.transport.PooledTransport'
+# max idle keep-alive connections kept open
+SMSFORMS_TOUCHFORMS_POOL_SIZE = 10
+# seconds
+SMSFORMS_TOUCHFORMS_TIMEOUT = 30
+# retries of failed requests that are safe to retry
+SMSFORMS_TOUCHFORMS_RETRIES = 2
+# seconds to wait before the first retry, doubling after that
+SMSFORMS_TOUCHFORMS_BACKOFF = 0.5
+
+# number of sessions whose current question is remembered, so answers can be
+# validated without asking touchforms for it. Only safe when each session's
+# messages are handled by the same router process; set to 0 otherwise.
+SMSFORMS_QUESTION_CACHE_SIZE = 10000
+
+# worker threads sending responses in the background, see outbound.py.
+# 0 sends them from the message handling thread as usual.
+SMSFORMS_OUTBOUND_WORKERS = 0
+# max responses queued per worker
+SMSFORMS_OUTBOUND_QUEUE_SIZE = 1000
+# seconds to wait for room in a full queue before warning about it (responses
+# are never sent out of order, so they then keep waiting)
+SMSFORMS_OUTBOUND_TIMEOUT = 30
+
+# where hot path counters and timings are sent, as a list of dotted paths to
+# sink classes in smsforms.metrics (e.g. 'smsforms.metrics.StatsdSink').
+# Nothing is measured when empty.
+SMSFORMS_METRICS_SINKS = []
+# where StatsdSink sends to, and the prefix of its metric names
+SMSFORMS_STATSD_HOST = 'localhost'
+SMSFORMS_STATSD_PORT = 8125
+SMSFORMS_STATSD_PREFIX = 'smsforms'
+
+# locks serializing the handling of each connection's messages, see locks.py
+SMSFORMS_LOCK_STRIPES = 1024
+# also take a postgres advisory lock per connection, for when several router
+# processes handle messages at once
+SMSFORMS_ADVISORY_LOCKS = False
+# worker threads handling messages in parallel across connections (each
+# connection's messages are still handled in order). 0 handles them in the
+# router's thread as usual. Responses are then sent by the outbound workers.
+SMSFORMS_INBOUND_WORKERS = 0
+# max messages queued per worker
+SMSFORMS_INBOUND_QUEUE_SIZE = 1000
+
+# threads making the requests of the non-blocking touchforms client (see
+# AsyncTouchformsClient in client.py), and max requests queued per thread.
+# Only broadcasts and form prewarming use it, not message handling.
+SMSFORMS_TOUCHFORMS_ASYNC_WORKERS = 50
+SMSFORMS_TOUCHFORMS_ASYNC_QUEUE_SIZE = 1000
+
+# seconds a session can go unanswered before the reaper ends it, see reaper.py
+SMSFORMS_SESSION_TTL = 60 * 60 * 24
+# seconds between the TouchFormsApp's runs of the reaper. 0 leaves reaping to
+# the smsformsreap command (e.g. from cron).
+SMSFORMS_REAPER_INTERVAL = 0
+# sessions ended per UPDATE
+SMSFORMS_REAPER_BATCH_SIZE = 1000
+
+# days after they end that sessions are moved to the archive table, see
+# archive.py. Keep this longer than SMSFORMS_POSTSESSION_LOCKOUT.
+SMSFORMS_ARCHIVE_AFTER_DAYS = 90
+# sessions moved per transaction
+SMSFORMS_ARCHIVE_BATCH_SIZE = 1000
+
+# have touchforms load each form (by starting a throwaway session) whenever
+# smsforms loads its definition, see formdefs.py
+SMSFORMS_PREWARM_TOUCHFORMS = False
+
+# play forms without skip logic, calculations, constraints or groups (and
+# only text, number and select questions) in-process instead of in
+# touchforms, see walker.py. Their progress is kept in the django cache.
+SMSFORMS_LOCAL_FORMS = False
+
+# max first questions a broadcast sends per second, see broadcast.py
+SMSFORMS_BROADCAST_RATE = 10
+# connections started per batch (their touchforms sessions are started
+# concurrently, by the SMSFORMS_TOUCHFORMS_ASYNC_WORKERS)
+SMSFORMS_BROADCAST_BATCH_SIZE = 100
@@ -1,12 +1,44 @@
 from django.dispatch import Signal
 from touchforms.formplayer.signals import sms_form_complete
 from threadless_router.router import Router
+import threading
 
 form_complete = Signal(providing_args=["session", "form", "router"])
 
 # TODO: this is never actually raised. needs update
 form_error = Signal(providing_args=["session", "form", "router"])
 
+class SessionCompletions(object):
+    """
+    Lets code that is driving a touchforms session find out that the form
+    was completed (and the session ended by handle_sms_form_complete)
+    without going back to the database.
+
+    Only sessions that are being watched are tracked.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watched = {}
+
+    def watch(self, session_id):
+        with self._lock:
+            self._watched[session_id] = False
+
+    def forget(self, session_id):
+        with self._lock:
+            self._watched.pop(session_id, None)
+
+    def complete(self, session_id):
+        with self._lock:
+            if session_id in self._watched:
+                self._watched[session_id] = True
+
+    def is_complete(self, session_id):
+        return self._watched.get(session_id, False)
+
+session_completions = SessionCompletions()
+
 def handle_sms_form_complete(sender, session_id, form, **kwargs):
     """
     When touchforms completes a form via sms this signal is raised.
@@ -14,20 +46,54 @@ def handle_sms_form_complete(sender, session_id, form, **kwargs):
     Catch it, save our session objects, and reraise a signal of our own.
     """
     from smsforms.models import XFormsSession
-    from smsforms.app import router_factory
+    from smsforms.routers import router_factory
 
     # implicit length assert that i'm sure is not always valid
     
-    sessions = XFormsSession.objects.filter(session_id=session_id, ended=False).order_by('-modified_time')
-    # there may be other open sessions so close them all
-    for s in sessions:
-        s.end()
-        
+    sessions = list(XFormsSession.objects.filter(session_id=session_id, ended=False).order_by('-modified_time'))
     # the one we want to process is the most recent one though
     session = sessions[0]
     # TODO: clean up this router business
+    # (look it up before ending the session drops it from the registry)
     router = router_factory.get(session.session_id)
+
+    # there may be other open sessions so close them all
+    for s in sessions:
+        s.end()
+    session_completions.complete(session_id)
+        
     form_complete.send(sender="smsforms", session=session,
                        form=form, router=router)
             
 sms_form_complete.connect(handle_sms_form_complete)
+
+def handle_trigger_changed(sender, instance, **kwargs):
+    """
+    Rebuild the trigger keyword index (in every process) whenever a
+    DecisionTrigger or XForm is saved or deleted. The definition of its
+    form is loaded again (and touchforms prewarmed) when it's saved, and
+    dropped when it's deleted.
+    """
+    from django.core.exceptions import ObjectDoesNotExist
+    from smsforms.triggers import trigger_index
+    from smsforms.formdefs import form_definitions
+    trigger_index.invalidate()
+    try:
+        xform = instance.xform if hasattr(instance, 'trigger_keyword') else instance
+        form_path = xform.file.path
+    except (ObjectDoesNotExist, ValueError):
+        # no form, or no file for it: nothing is cached for it either
+        return
+    if 'created' in kwargs:
+        # saved (only post_save sends created)
+        form_definitions.warm_form(form_path)
+    else:
+        form_definitions.discard(form_path)
+
+
+def handle_session_deleted(sender, instance, **kwargs):
+    """
+    Keep the active session cache from handing out deleted sessions.
+    """
+    from smsforms.sessioncache import session_cache
+    session_cache.discard(instance.connection_id)
@@ -0,0 +1,90 @@
+from django.db import connection, transaction
+from smsforms.models import SessionSnapshot
+from smsforms.sessioncache import session_cache
+from smsforms.routers import router_factory
+from smsforms.client import touchforms_client
+from smsforms.metrics import metrics
+import logging
+import json
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotStore(object):
+    """
+    Keeps the answers given in each session (see SessionSnapshot) and
+    rebuilds touchforms sessions from them.
+
+    Answers are appended to the session's log in place, with a single
+    UPDATE (or an INSERT for the first one), rather than stored one row
+    per answer. touchforms has no way to take many answers in one
+    request, so a rebuild replays them one after another.
+    """
+
+    def _append_sql(self):
+        table = SessionSnapshot._meta.db_table
+        if connection.vendor == 'mysql':
+            return 'UPDATE %s SET answers = CONCAT(answers, %%s) WHERE session_id = %%s' % table
+        return 'UPDATE %s SET answers = answers || %%s WHERE session_id = %%s' % table
+
+    def record(self, session, answer):
+        """
+        Appends an answer touchforms accepted to the session's log.
+        """
+        line = json.dumps(answer) + '\n'
+        cursor = connection.cursor()
+        cursor.execute(self._append_sql(), [line, session.pk])
+        if not cursor.rowcount:
+            SessionSnapshot.objects.create(session=session, answers=line)
+        transaction.commit_unless_managed()
+
+    def answers(self, session):
+        try:
+            log = SessionSnapshot.objects.get(session=session).answers
+        except SessionSnapshot.DoesNotExist:
+            return []
+        return [json.loads(line) for line in log.splitlines() if line]
+
+    def restore(self, app, contact, session):
+        """
+        Starts a new touchforms session for the session's form, replays the
+        answers given so far and points the session at it.
+
+        Returns whether the session could be rebuilt. If it couldn't, what
+        we know of the new touchforms session is forgotten (touchforms has
+        no call to end it, its next purge drops it) and the session is
+        left as it was.
+        """
+        answers = self.answers(session)
+        config, _ = app._session_config(contact, session.trigger)
+        session_id = None
+        try:
+            session_id, responses = touchforms_client.start_session(config)
+            for answer in answers:
+                if responses[-1].is_error:
+                    break
+                responses = touchforms_client.next_responses(session_id, answer)
+            error = responses[-1].error if responses[-1].is_error else None
+        except Exception, e:
+            logger.exception('Error rebuilding session %s' % session.session_id)
+            error = e
+        if error is not None:
+            logger.error('Could not rebuild session %s: %s' % (session.session_id, error))
+            if session_id:
+                touchforms_client.forget(session_id)
+            metrics.incr('sessions.restore_failed')
+            return False
+
+        logger.info('Rebuilt session %s as %s from %s answers' % (session.session_id, session_id,
+                                                                  len(answers)))
+        old_session_id = session.session_id
+        session.session_id = session_id
+        session.save()
+        touchforms_client.forget(old_session_id)
+        router_factory.discard(old_session_id)
+        router_factory.set(session_id, app.router)
+        session_cache.set(session.connection_id, session)
+        metrics.incr('sessions.restored')
+        return True
+
+session_snapshots = SnapshotStore()
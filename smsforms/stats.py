@@ -0,0 +1,69 @@
+from collections import defaultdict, Counter
+from django.db.models import F
+from datetime import datetime
+
+# (max seconds, DailySessionStats field) for the session length histogram
+DURATION_BUCKETS = (
+    (60, 'duration_1m'),
+    (5 * 60, 'duration_5m'),
+    (15 * 60, 'duration_15m'),
+    (60 * 60, 'duration_1h'),
+    (24 * 60 * 60, 'duration_1d'),
+)
+DURATION_OVERFLOW = 'duration_over_1d'
+
+
+def duration_bucket(seconds):
+    for limit, field in DURATION_BUCKETS:
+        if seconds <= limit:
+            return field
+    return DURATION_OVERFLOW
+
+
+def ended_counts(session):
+    """
+    Returns the DailySessionStats increments for a session that ended.
+    Sessions that hit an error are counted as errored on the day they end
+    (not when the error happened), so the backfill can tell the same story.
+    """
+    counts = {'ended': 1}
+    if session.has_error:
+        counts['errored'] = 1
+    if session.cancelled:
+        counts['cancelled'] = 1
+    elif not session.has_error:
+        counts['completed'] = 1
+    if session.start_time and session.end_time:
+        duration = session.end_time - session.start_time
+        seconds = max(duration.days * 24 * 60 * 60 + duration.seconds, 0)
+        counts['total_duration'] = seconds
+        counts[duration_bucket(seconds)] = 1
+    return counts
+
+
+def add(trigger_id, day, counts):
+    """
+    Adds counts to the trigger's stats for the day, in the database.
+    """
+    from smsforms.models import DailySessionStats
+    row, _ = DailySessionStats.objects.get_or_create(trigger_id=trigger_id, day=day)
+    DailySessionStats.objects.filter(pk=row.pk).update(
+        **dict((field, F(field) + value) for field, value in counts.items()))
+
+
+def record_ended(session):
+    add(session.trigger_id, (session.end_time or datetime.utcnow()).date(),
+        ended_counts(session))
+
+
+def record_ended_many(sessions):
+    """
+    Like record_ended for many sessions, with one update per trigger and day.
+    """
+    totals = defaultdict(Counter)
+    for session in sessions:
+        day = (session.end_time or datetime.utcnow()).date()
+        totals[(session.trigger_id, day)].update(ended_counts(session))
+    for (trigger_id, day), counts in totals.items():
+        add(trigger_id, day, counts)
+
@@ -6,6 +6,45 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from django.db import IntegrityError
+from rapidsms.models import Backend, Connection
+from rapidsms.messages.incoming import IncomingMessage
+from touchforms.formplayer.models import XForm
+from touchforms.formplayer.signals import sms_form_complete
+from touchforms.formplayer.api import XFormsConfig
+from smsforms.app import TouchFormsApp
+from smsforms.client import touchforms_client, TouchformsClient
+from smsforms.models import DecisionTrigger, XFormsSession, DailySessionStats, ArchivedSession
+from smsforms.triggers import trigger_index, VERSION_KEY
+from smsforms.sessioncache import session_cache
+from smsforms.routers import SessionRouterRegistry, router_factory
+from smsforms.lru import LRUCache
+from smsforms.outbound import OutboundDispatcher
+from smsforms.signals import SessionCompletions, session_completions
+from smsforms.workers import KeyedWorkerPool, Executor, TimeoutError
+from smsforms.validators import validator_for
+from smsforms.metrics import metrics, MemorySink
+from smsforms.transport import PooledTransport
+from smsforms.locks import StripedLocks, connection_lock
+from smsforms.reaper import reap
+from smsforms.archive import archive
+from smsforms.formdefs import form_definitions
+from smsforms.walker import is_local
+from smsforms.broadcast import broadcast
+from smsforms.snapshots import session_snapshots
+from smsforms import bench
+from smsforms.management.commands.smsformsreport import export_sessions, filter_sessions
+from smsforms.management.commands import smsformsreport
+from rapidsms.contrib.messagelog.models import Message
+from StringIO import StringIO
+import csv
+from rapidsms.conf import settings
+from django.core.cache import cache
+from datetime import datetime, timedelta
+import tempfile
+import threading
+import time
+import os
 
 
 class SimpleTest(TestCase):
@@ -14,3 +53,911 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+TEST_XFORM = """<?xml version="1.0"?>
+<h:html xmlns="http://www.w3.org/2002/xforms" xmlns:h="http://www.w3.org/1999/xhtml">
+  <h:head>
+    <h:title>Survey</h:title>
+    <model>
+      <instance>
+        <data xmlns="http://smsforms.test/survey">
+          <age/>
+        </data>
+      </instance>
+      <bind nodeset="/data/age" type="int"/>
+    </model>
+  </h:head>
+  <h:body>
+    <input ref="/data/age"><label>How old are you?</label></input>
+  </h:body>
+</h:html>
+"""
+
+
+class FakeResponse(object):
+    """
+    Stands in for a touchforms XformsResponse to a plain text question.
+    """
+    is_error = False
+    event = None
+
+    def __init__(self, text_prompt, session_id='fake-session'):
+        self.text_prompt = text_prompt
+        self.session_id = session_id
+
+
+class SmsFormsTestCase(TestCase):
+    """
+    Sets up a trigger and a connection, with touchforms stubbed out.
+    """
+
+    def setUp(self):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, TEST_XFORM)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        xform = XForm.from_file(path, 'survey')
+        self.trigger = DecisionTrigger.objects.create(xform=xform, trigger_keyword='survey')
+        backend = Backend.objects.create(name='mock')
+        self.connection = Connection.objects.create(backend=backend, identity='5551234')
+        self.app = TouchFormsApp(None)
+        # build the trigger index up front so it isn't counted below
+        trigger_index.get('survey')
+        session_cache.clear()
+        self._lockout = getattr(settings, 'SMSFORMS_POSTSESSION_LOCKOUT', None)
+        settings.SMSFORMS_POSTSESSION_LOCKOUT = None
+
+        touchforms_client.start_session = \
+            lambda config: ('fake-session', [FakeResponse('How old are you?')])
+        touchforms_client.next_responses = \
+            lambda session_id, answer, auth=None: [FakeResponse('Thanks!')]
+        touchforms_client.current_question = \
+            lambda session_id: FakeResponse('How old are you?')
+
+    def tearDown(self):
+        # back to the class' methods
+        for name in ('start_session', 'next_responses', 'current_question'):
+            touchforms_client.__dict__.pop(name, None)
+        settings.SMSFORMS_POSTSESSION_LOCKOUT = self._lockout
+
+    def _message(self, text):
+        return IncomingMessage(self.connection, text)
+
+    def _use_fake_touchforms(self, questions):
+        """
+        Has the real client play questions against the benchmark's
+        stand-in for touchforms.
+        """
+        for name in ('start_session', 'next_responses', 'current_question'):
+            del touchforms_client.__dict__[name]
+        self.touchforms = bench.FakeTouchforms(questions=questions)
+        self.touchforms.start()
+        self.addCleanup(self.touchforms.stop)
+        transport = touchforms_client._transport
+        touchforms_client._transport = PooledTransport(url=self.touchforms.url, retries=0)
+        self.addCleanup(setattr, touchforms_client, '_transport', transport)
+        self.addCleanup(touchforms_client._transport.close)
+
+    def _open_session(self):
+        now = datetime.utcnow()
+        return XFormsSession.objects.create(connection=self.connection, trigger=self.trigger,
+                                            session_id='fake-session', start_time=now,
+                                            modified_time=now, ended=False)
+
+
+class MessageRoutingQueryTest(SmsFormsTestCase):
+    """
+    Counts the database round-trips it takes to route a single message.
+    """
+
+    def setUp(self):
+        super(MessageRoutingQueryTest, self).setUp()
+        # the tests run in one process, so even a locmem cache is shared
+        shared, session_cache.shared = session_cache.shared, True
+        self.addCleanup(setattr, session_cache, 'shared', shared)
+
+    def test_non_form_message(self):
+        # one lookup to learn there is no open session
+        with self.assertNumQueries(1):
+            self.assertFalse(self.app.handle(self._message('hello there')))
+        # which is remembered for the next message
+        with self.assertNumQueries(0):
+            self.assertFalse(self.app.handle(self._message('hello again')))
+
+    def test_non_form_message_with_inbound_workers(self):
+        # deciding it isn't ours for the workers is the one lookup
+        self.app._inbound = Executor(workers=1, queue_size=1)
+        with self.assertNumQueries(1):
+            self.assertFalse(self.app.handle(self._message('hello there')))
+
+    def test_non_form_message_with_lockout(self):
+        # also checks for a recently ended session
+        settings.SMSFORMS_POSTSESSION_LOCKOUT = timedelta(minutes=5)
+        with self.assertNumQueries(2):
+            self.assertFalse(self.app.handle(self._message('hello there')))
+
+    def test_trigger_keyword_starts_session(self):
+        # session lookup, then the insert of the new session
+        msg = self._message('survey')
+        with self.assertNumQueries(2):
+            self.assertTrue(self.app.handle(msg))
+        self.assertEqual(1, XFormsSession.objects.filter(connection=self.connection,
+                                                         ended=False).count())
+
+    def test_answer_in_open_session(self):
+        self._open_session()
+        # session lookup, its modified_time and the answer's snapshot
+        # (created with the first answer)
+        with self.assertNumQueries(4):
+            self.assertTrue(self.app.handle(self._message('42')))
+        with self.assertNumQueries(2):
+            self.assertTrue(self.app.handle(self._message('43')))
+
+    def test_ended_session_is_not_cached(self):
+        session = self._open_session()
+        self.app.handle(self._message('42'))
+        session.end()
+        with self.assertNumQueries(1):
+            self.assertFalse(self.app.handle(self._message('43')))
+
+
+class TriggerIndexTest(SmsFormsTestCase):
+
+    def test_rebuilds_until_change_is_committed(self):
+        # another process is saving a trigger we can't see yet
+        cache.set(VERSION_KEY, ('uncommitted', time.time()), 60)
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                self.assertTrue(trigger_index.get('survey') is not None)
+        # once the stamp matches what we see, the index is kept
+        trigger_index.invalidate()
+        trigger_index.get('survey')
+        with self.assertNumQueries(0):
+            self.assertTrue(trigger_index.get('survey') is not None)
+
+
+class SessionRouterRegistryTest(TestCase):
+
+    def test_bounded(self):
+        registry = SessionRouterRegistry(max_size=2)
+        for session_id in ('a', 'b', 'c'):
+            registry.set(session_id, 'router-%s' % session_id)
+        self.assertEqual(2, registry.size)
+        self.assertEqual('router-c', registry.get('c'))
+
+    def test_falls_back_to_default(self):
+        registry = SessionRouterRegistry()
+        self.assertRaises(ValueError, registry.get, 'gone')
+        registry.set_default('default-router')
+        registry.set('a', 'router-a')
+        registry.discard('a')
+        self.assertEqual('default-router', registry.get('a'))
+        self.assertEqual(1, registry.stats()['fallbacks'])
+
+
+class SessionCompletionsTest(SmsFormsTestCase):
+
+    def test_registry(self):
+        completions = SessionCompletions()
+        # sessions nobody watches aren't tracked
+        completions.complete('a')
+        self.assertFalse(completions.is_complete('a'))
+        completions.watch('b')
+        self.assertFalse(completions.is_complete('b'))
+        completions.complete('b')
+        self.assertTrue(completions.is_complete('b'))
+        completions.forget('b')
+        self.assertFalse(completions.is_complete('b'))
+
+    def test_whole_form_sees_completion(self):
+        def next_responses(session_id, answer, auth=None):
+            self.assertTrue(session_id in session_completions._watched)
+            sms_form_complete.send(sender='touchforms', session_id=session_id, form='<data/>')
+            return [FakeResponse('Thanks!')]
+        touchforms_client.next_responses = next_responses
+        msg = self._message('survey 42')
+        self.app.handle(msg)
+        session = XFormsSession.objects.get(connection=self.connection)
+        self.assertTrue(session.ended)
+        self.assertFalse(session.has_error)
+        self.assertEqual([], [r.text for r in msg.responses if r.text.startswith('Incomplete')])
+        self.assertFalse(session.session_id in session_completions._watched)
+
+
+class KeyedWorkerPoolTest(TestCase):
+
+    def test_jobs_per_key_stay_in_order(self):
+        handled = []
+        pool = KeyedWorkerPool(handled.extend, workers=3, queue_size=5, batch_size=4)
+        pool.start()
+        for i in range(50):
+            pool.submit(i % 7, (i % 7, i))
+        pool.stop()
+        self.assertEqual(50, len(handled))
+        for key in range(7):
+            jobs = [i for k, i in handled if k == key]
+            self.assertEqual(sorted(jobs), jobs)
+
+
+class FakeEvent(object):
+
+    def __init__(self, datatype, choices=None):
+        self.datatype = datatype
+        self.choices = choices
+
+
+class ValidatorTest(TestCase):
+
+    def _validate(self, text, datatype, choices=None):
+        response = FakeResponse('Question?')
+        response.event = FakeEvent(datatype, choices)
+        return validator_for(response).validate(text)
+
+    def test_int(self):
+        self.assertEqual((42, None), self._validate('42', 'int'))
+        self.assertEqual(('old', 'Answer must be a number!'), self._validate('old', 'int'))
+
+    def test_select(self):
+        choices = ['Red', 'Green', 'Blue']
+        self.assertEqual(('2', None), self._validate('green', 'select', choices))
+        self.assertEqual(('1 3', None), self._validate('1,blue', 'multiselect', choices))
+        self.assertEqual(('4', 'Answer 4 must be between 1 and 3'),
+                         self._validate('4', 'select', choices))
+        self.assertEqual(('pink', 'Answer must be one of the choices'),
+                         self._validate('pink', 'select', choices))
+        self.assertEqual(('', None), self._validate('', 'select', choices))
+
+
+class DailySessionStatsTest(SmsFormsTestCase):
+
+    def test_ended_sessions_are_counted(self):
+        self._open_session().end()
+        self._open_session().cancel()
+        stats = DailySessionStats.objects.get(trigger=self.trigger)
+        self.assertEqual(2, stats.ended)
+        self.assertEqual(1, stats.completed)
+        self.assertEqual(1, stats.cancelled)
+        self.assertEqual(2, stats.duration_1m)
+
+    def test_turned_away_submissions_are_not_completed(self):
+        self.app.handle(self._message('survey old'))
+        session = XFormsSession.objects.get(connection=self.connection)
+        self.assertTrue(session.has_error)
+        stats = DailySessionStats.objects.get(trigger=self.trigger)
+        self.assertEqual((1, 0, 1), (stats.ended, stats.completed, stats.errored))
+
+
+class MetricsTest(SmsFormsTestCase):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.sink = MemorySink()
+        metrics.add_sink(self.sink)
+
+    def tearDown(self):
+        metrics.remove_sink(self.sink)
+        super(MetricsTest, self).tearDown()
+
+    def test_session_counters(self):
+        self._open_session().end()
+        self._open_session().cancel()
+        self.assertEqual(2, self.sink.counters['sessions.ended'])
+        self.assertEqual(1, self.sink.counters['sessions.cancelled'])
+
+    def test_timer(self):
+        with metrics.timer('block'):
+            pass
+        self.assertEqual(1, len(self.sink.timings['block']))
+        metrics.remove_sink(self.sink)
+        with metrics.timer('block'):
+            pass
+        metrics.add_sink(self.sink)
+        self.assertEqual(1, len(self.sink.timings['block']))
+
+
+class FakeTouchformsTest(TestCase):
+
+    def setUp(self):
+        self.touchforms = bench.FakeTouchforms()
+        self.touchforms.start()
+        self.transport = PooledTransport(url=self.touchforms.url, retries=0)
+
+    def tearDown(self):
+        self.transport.close()
+        self.touchforms.stop()
+
+    def test_plays_through_the_form(self):
+        response = self.transport.request({'action': 'new-form'})
+        session_id = response['session_id']
+        self.assertEqual('int', response['event']['datatype'])
+        response = self.transport.request({'action': 'answer', 'session-id': session_id,
+                                           'answer': 'old'})
+        self.assertEqual('validation-error', response['status'])
+        for answer in bench.BENCH_ANSWERS:
+            response = self.transport.request({'action': 'answer', 'session-id': session_id,
+                                               'answer': answer})
+        self.assertEqual('form-complete', response['event']['type'])
+        self.assertEqual(2 + len(bench.BENCH_ANSWERS), self.touchforms.requests)
+
+    def test_client_sends_numbers(self):
+        client = TouchformsClient(transport=self.transport)
+        session_id, responses = client.start_session(XFormsConfig(form_path='bench.xml'))
+        # session ids are kept as strings, answers come in as text
+        self.assertEqual('1', session_id)
+        responses = client.next_responses(session_id, '42')
+        self.assertFalse(responses[-1].is_error)
+        responses = client.next_responses(session_id, '2')
+        self.assertFalse(responses[-1].is_error)
+        self.assertEqual((2, [42, 2]), self.touchforms.sessions[1])
+
+    def test_client_remembers_current_question(self):
+        client = TouchformsClient(transport=self.transport)
+        client._questions = LRUCache(1)
+        session_id, _ = client.start_session(XFormsConfig(form_path='bench.xml'))
+        requests = self.touchforms.requests
+        # looked up by the id stored in the database
+        self.assertFalse(client.current_question(unicode(session_id)).is_error)
+        self.assertEqual(requests, self.touchforms.requests)
+        # pushed out by another session
+        client.start_session(XFormsConfig(form_path='bench.xml'))
+        requests = self.touchforms.requests
+        self.assertFalse(client.current_question(unicode(session_id)).is_error)
+        self.assertEqual(requests + 1, self.touchforms.requests)
+
+    def test_percentile(self):
+        self.assertEqual(50, bench.percentile(range(101), 50))
+        self.assertEqual(99, bench.percentile(range(101), 99))
+        self.assertEqual(0.0, bench.percentile([], 99))
+
+
+class SlowRouter(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def outgoing(self, msg):
+        time.sleep(0.01)
+        self.sent.append(msg.text)
+
+
+class OutboundDispatcherTest(SmsFormsTestCase):
+
+    def setUp(self):
+        super(OutboundDispatcherTest, self).setUp()
+        self._queue_size = settings.SMSFORMS_OUTBOUND_QUEUE_SIZE
+        self._timeout = settings.SMSFORMS_OUTBOUND_TIMEOUT
+        settings.SMSFORMS_OUTBOUND_QUEUE_SIZE = 1
+        settings.SMSFORMS_OUTBOUND_TIMEOUT = 0.001
+
+    def tearDown(self):
+        settings.SMSFORMS_OUTBOUND_QUEUE_SIZE = self._queue_size
+        settings.SMSFORMS_OUTBOUND_TIMEOUT = self._timeout
+        super(OutboundDispatcherTest, self).tearDown()
+
+    def test_full_queue_keeps_order(self):
+        router = SlowRouter()
+        dispatcher = OutboundDispatcher()
+        dispatcher.start(router, workers=1)
+        msg = self._message('survey')
+        texts = ['response %s' % i for i in range(5)]
+        for text in texts:
+            dispatcher.respond(msg, text)
+        dispatcher.stop()
+        self.assertEqual(texts, router.sent)
+        self.assertEqual([], msg.responses)
+
+
+class ConnectionLockTest(TestCase):
+
+    def test_striped_locks(self):
+        locks = StripedLocks(16)
+        self.assertTrue(locks.lock_for(3) is locks.lock_for(3))
+        self.assertFalse(locks.lock_for(3) is locks.lock_for(4))
+
+    def test_connection_lock_is_reentrant(self):
+        with connection_lock(42):
+            with connection_lock(42):
+                pass
+
+
+class ExecutorTest(TestCase):
+
+    def setUp(self):
+        self.executor = Executor(workers=2, queue_size=10)
+        self.executor.start()
+
+    def tearDown(self):
+        self.executor.stop()
+
+    def test_results(self):
+        futures = [self.executor.submit(i, pow, i, 2) for i in range(5)]
+        self.assertEqual([0, 1, 4, 9, 16], [f.result(5) for f in futures])
+        done = []
+        futures[0].add_done_callback(done.append)
+        self.assertEqual([futures[0]], done)
+
+    def test_exceptions(self):
+        future = self.executor.submit('key', int, 'old')
+        self.assertRaises(ValueError, future.result, 5)
+
+    def test_timeout(self):
+        self.executor.submit('key', time.sleep, 0.5)
+        self.assertRaises(TimeoutError, self.executor.submit('key', int, '1').result, 0.01)
+
+
+def one_open_session_per_connection(test):
+    """
+    Makes saving a second open session for a connection fail, as the index
+    migration 0012 adds on postgres does.
+    """
+    save = XFormsSession.save
+
+    def checked_save(session, *args, **kwargs):
+        if not session.ended and XFormsSession.objects.filter(
+                connection=session.connection_id, ended=False).exclude(pk=session.pk).exists():
+            raise IntegrityError('duplicate key value violates unique constraint')
+        save(session, *args, **kwargs)
+    XFormsSession.save = checked_save
+    test.addCleanup(setattr, XFormsSession, 'save', save)
+
+
+class SessionConflictTest(SmsFormsTestCase):
+
+    def setUp(self):
+        super(SessionConflictTest, self).setUp()
+        one_open_session_per_connection(self)
+
+    def test_newest_session_wins(self):
+        # opened by another process since we looked
+        other = self._open_session()
+        session, _ = self.app._start_session(self._message('survey'), self.trigger)
+        self.assertEqual([session.pk], [s.pk for s in XFormsSession.objects.filter(ended=False)])
+        self.assertTrue(XFormsSession.objects.get(pk=other.pk).cancelled)
+
+    def test_concurrent_keywords(self):
+        ids = iter(range(100))
+        starting = []
+
+        def start_session(config):
+            if not starting:
+                starting.append(config)
+                # the same keyword arrives again, and is handled elsewhere
+                # while touchforms starts this session
+                self.app._handle(self._message('survey'))
+            return 'fake-session-%s' % next(ids), [FakeResponse('How old are you?')]
+        touchforms_client.start_session = start_session
+        self.app._handle(self._message('survey'))
+        sessions = XFormsSession.objects.order_by('pk')
+        self.assertEqual([True, False], [s.cancelled for s in sessions])
+        self.assertEqual([True, False], [s.ended for s in sessions])
+        self.assertEqual(sessions[1].pk, self.app.get_session(self._message('42')).pk)
+
+
+class OtherApp(object):
+    """
+    An app the router hands messages to after the TouchFormsApp.
+    """
+
+    def __init__(self):
+        self.handled = []
+
+    def handle(self, msg):
+        self.handled.append(msg.text)
+        msg.respond('Not a form')
+        return True
+
+    def default(self, msg):
+        return False
+
+
+class InboundWorkersTest(SmsFormsTestCase):
+
+    def setUp(self):
+        super(InboundWorkersTest, self).setUp()
+        self.other = OtherApp()
+        self.app.router = FakeRouter([self.app, self.other])
+        self.app._inbound = Executor(workers=2, queue_size=10)
+        self.app._inbound.start()
+        self.release = threading.Event()
+        self.handled = []
+
+        # the workers' threads can't see the test database, so record what
+        # they get instead
+        def _handle(msg, ctx=None):
+            self.release.wait(5)
+            self.handled.append(msg.text)
+            return msg.text != 'hello'
+        self.app._handle = _handle
+
+    def test_messages_wait_for_those_queued_before(self):
+        self.assertTrue(self.app.handle(self._message('survey')))
+        # no session yet, but the keyword ahead of it may start one
+        self.assertTrue(self.app.handle(self._message('42')))
+        self.release.set()
+        self.app._inbound.stop()
+        self.assertEqual(['survey', '42'], self.handled)
+        self.assertEqual({}, self.app._queued)
+
+    def test_messages_that_arent_ours_are_passed_on(self):
+        self.assertTrue(self.app.handle(self._message('survey')))
+        self.assertTrue(self.app.handle(self._message('hello')))
+        self.release.set()
+        self.app._inbound.stop()
+        self.assertEqual(['hello'], self.other.handled)
+        self.assertEqual(['Not a form'], [msg.text for msg in self.app.router.sent])
+        # with nothing queued, messages that aren't ours aren't claimed
+        self.assertFalse(self.app.handle(self._message('hello')))
+
+
+class ReportTest(SmsFormsTestCase):
+
+    def _log(self, text, date):
+        # messagelog dates are an hour ahead of the sessions', see smsformsreport
+        Message.objects.create(connection=self.connection, direction='I', text=text,
+                               date=date - timedelta(hours=1))
+
+    def test_exports_each_sessions_messages(self):
+        start = datetime(2012, 1, 1, 12)
+        ended = self._open_session()
+        ended.start_time, ended.ended = start, True
+        ended.end_time = start + timedelta(minutes=10)
+        ended.save()
+        still_open = self._open_session()
+        still_open.start_time = start + timedelta(minutes=30)
+        still_open.save()
+        self._log('survey', start + timedelta(minutes=1))
+        self._log('hello', start + timedelta(minutes=20))
+        self._log('42', start + timedelta(minutes=40))
+
+        f = StringIO()
+        self.assertEqual(still_open.pk, export_sessions(XFormsSession.objects.all(), f, 1))
+        rows = list(csv.reader(StringIO(f.getvalue())))
+        texts = [row[1] for row in rows if row and row[0] == '' and len(row) == 4]
+        self.assertEqual(['Text', 'survey', 'Text', '42'], texts)
+        metadata = [row for row in rows if row and row[0] == 'fake-session']
+        self.assertEqual('None', metadata[1][4])
+
+    def test_time_shards_cover_every_session(self):
+        for minutes in (0, 30, 60):
+            session = self._open_session()
+            session.start_time = datetime(2012, 1, 1, 12) + timedelta(minutes=minutes)
+            session.save()
+        session = self._open_session()
+        session.start_time = None
+        session.save()
+        shards = smsformsreport.Command().shard_filters({}, 2, 'time')
+        self.assertEqual(4, sum(filter_sessions(**shard).count() for shard in shards))
+
+
+class ReaperTest(SmsFormsTestCase):
+
+    def setUp(self):
+        super(ReaperTest, self).setUp()
+        touchforms_client.purge_stale = lambda window: True
+        self.addCleanup(delattr, touchforms_client, 'purge_stale')
+
+    def test_reaps_idle_sessions(self):
+        stale = self._open_session()
+        stale.modified_time = datetime.utcnow() - timedelta(days=2)
+        stale.save()
+        self.app.get_session(self._message('hi'))
+        self.assertEqual(1, reap(ttl=60 * 60 * 24))
+        stale = XFormsSession.objects.get(pk=stale.pk)
+        self.assertTrue(stale.ended)
+        self.assertTrue(stale.cancelled)
+        self.assertEqual(None, self.app.get_session(self._message('hi')))
+        self.assertEqual(1, DailySessionStats.objects.get(trigger=self.trigger).cancelled)
+        self.assertEqual(0, reap(ttl=60 * 60 * 24))
+
+    def test_spares_sessions_being_answered(self):
+        session = self._open_session()
+        session.start_time = session.modified_time = datetime.utcnow() - timedelta(days=2)
+        session.save()
+        self.app.handle(self._message('42'))
+        self.assertEqual(0, reap(ttl=60 * 60 * 24))
+        self.assertFalse(XFormsSession.objects.get(pk=session.pk).ended)
+        self.assertFalse(DailySessionStats.objects.filter(trigger=self.trigger).exists())
+
+
+class ArchiveTest(SmsFormsTestCase):
+
+    def test_archives_old_sessions(self):
+        old = self._open_session()
+        old.end()
+        old.end_time = datetime.utcnow() - timedelta(days=100)
+        old.save()
+        recent = self._open_session()
+        recent.end()
+        self.assertEqual(1, archive(days=90))
+        self.assertEqual([recent.pk], [s.pk for s in XFormsSession.objects.all()])
+        archived = ArchivedSession.objects.get(pk=old.pk)
+        self.assertEqual(self.connection, archived.connection)
+        self.assertEqual(old.end_time, archived.end_time)
+        self.assertEqual(0, archive(days=90))
+
+
+class FormDefinitionTest(SmsFormsTestCase):
+
+    def test_parses_questions(self):
+        definition = form_definitions.get(self.trigger.xform.file.path)
+        self.assertEqual('Survey', definition.title)
+        self.assertEqual(['/data/age'], [q.ref for q in definition.questions])
+        self.assertEqual('int', definition.questions[0].datatype)
+        self.assertEqual('How old are you?', definition.questions[0].caption())
+        self.assertFalse(definition.has_logic)
+        self.assertEqual([], definition.languages)
+        self.assertEqual('', definition.resolve_language('fr'))
+
+    def test_cached(self):
+        path = self.trigger.xform.file.path
+        self.assertTrue(form_definitions.get(path) is form_definitions.get(path))
+
+    def test_loaded_when_trigger_is_saved(self):
+        path = self.trigger.xform.file.path
+        form_definitions.get(path)
+        with open(path, 'w') as f:
+            f.write(TEST_XFORM.replace('How old are you?', 'What is your age?'))
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.trigger.save()
+        # loaded on save rather than on the form's next message
+        self.assertEqual(os.stat(path).st_mtime, form_definitions._definitions[path][0])
+        self.assertEqual('What is your age?', form_definitions.get(path).questions[0].caption())
+
+
+class LocalFormsTest(SmsFormsTestCase):
+
+    def setUp(self):
+        super(LocalFormsTest, self).setUp()
+        # play the survey for real, locally
+        for name in ('start_session', 'next_responses', 'current_question'):
+            del touchforms_client.__dict__[name]
+        self._local_forms = settings.SMSFORMS_LOCAL_FORMS
+        settings.SMSFORMS_LOCAL_FORMS = True
+
+    def tearDown(self):
+        settings.SMSFORMS_LOCAL_FORMS = self._local_forms
+        super(LocalFormsTest, self).tearDown()
+
+    def test_plays_simple_form(self):
+        self.app.handle(self._message('survey'))
+        session = XFormsSession.objects.get(connection=self.connection)
+        self.assertTrue(is_local(session.session_id))
+        self.assertFalse(session.ended)
+        self.app.handle(self._message('old'))
+        self.assertFalse(XFormsSession.objects.get(pk=session.pk).ended)
+        self.app.handle(self._message('42'))
+        self.assertTrue(XFormsSession.objects.get(pk=session.pk).ended)
+
+    def test_whole_form(self):
+        self.app.handle(self._message('survey 42'))
+        session = XFormsSession.objects.get(connection=self.connection)
+        self.assertTrue(session.ended)
+        self.assertFalse(session.has_error)
+
+
+class FakeTouchformsAppTest(SmsFormsTestCase):
+    """
+    Plays the survey through the real client, against the benchmark's
+    stand-in for touchforms (which numbers its sessions, like touchforms).
+    """
+
+    def setUp(self):
+        super(FakeTouchformsAppTest, self).setUp()
+        # the survey's one question
+        self._use_fake_touchforms(bench.BENCH_QUESTIONS[:1])
+
+    def test_interactive(self):
+        self.app.handle(self._message('survey'))
+        session = XFormsSession.objects.get(connection=self.connection)
+        self.assertEqual(u'1', session.session_id)
+        # the second message finds the cached session
+        self.app.handle(self._message('42'))
+        session = XFormsSession.objects.get(pk=session.pk)
+        self.assertTrue(session.ended)
+        self.assertFalse(session.has_error)
+
+    def test_whole_form(self):
+        self.app.handle(self._message('survey 42'))
+        session = XFormsSession.objects.get(connection=self.connection)
+        self.assertTrue(session.ended)
+        self.assertFalse(session.has_error)
+
+    def test_router_registered_by_stored_id(self):
+        router = FakeRouter()
+        self.app = TouchFormsApp(router)
+        default = router_factory.default
+        router_factory.set_default('default-router')
+        self.addCleanup(router_factory.set_default, default)
+        self.app.handle(self._message('survey'))
+        session = XFormsSession.objects.get(connection=self.connection)
+        self.assertTrue(router_factory.get(session.session_id) is router)
+        session.end()
+        self.assertEqual('default-router', router_factory.get(session.session_id))
+
+
+class BenchTest(SmsFormsTestCase):
+
+    def setUp(self):
+        super(BenchTest, self).setUp()
+        self._use_fake_touchforms(bench.BENCH_QUESTIONS)
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, bench.BENCH_XFORM)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        xform = XForm.from_file(path, 'smsforms benchmark')
+        self.bench_trigger = DecisionTrigger.objects.create(xform=xform,
+                                                            trigger_keyword=bench.BENCH_KEYWORD)
+
+    def test_runs_every_scenario(self):
+        connections = dict((scenario, [
+            Connection.objects.create(backend=self.connection.backend,
+                                      identity='%s-%s' % (scenario, i)) for i in range(2)])
+            for scenario in bench.SCENARIOS)
+        results = bench.run(self.app, self.touchforms, bench.traffic(connections))
+        self.assertEqual(sum(2 * len(script()) for script in bench.SCENARIOS.values()),
+                         results['total'].summary()['messages'])
+        sessions = XFormsSession.objects.filter(trigger=self.bench_trigger)
+        self.assertTrue(sessions.exists())
+        self.assertFalse(sessions.filter(ended=False).exists())
+        self.assertFalse(sessions.filter(has_error=True).exists())
+
+
+class SessionLanguageTest(SmsFormsTestCase):
+
+    def test_falls_back_without_asking_touchforms(self):
+        self.trigger.context_data = '{"_lang": "fr"}'
+        self.trigger.save()
+        configs = []
+        touchforms_client.start_session = lambda config: \
+            configs.append(config) or ('fake-session', [FakeResponse('How old are you?')])
+        sink = MemorySink()
+        metrics.add_sink(sink)
+        self.addCleanup(metrics.remove_sink, sink)
+        self.app.handle(self._message('survey'))
+        # the survey has no translations, so that's no fallback
+        self.assertEqual([''], [config.language for config in configs])
+        self.assertFalse(sink.counters.get('sessions.language_fallback'))
+
+
+class FakeRouter(object):
+
+    def __init__(self, apps=()):
+        self.apps = list(apps)
+        self.sent = []
+
+    def outgoing(self, msg):
+        self.sent.append(msg)
+
+
+class BroadcastTest(SmsFormsTestCase):
+
+    def test_starts_sessions(self):
+        ids = iter(range(100))
+        touchforms_client.start_session = lambda config: \
+            ('fake-session-%s' % next(ids), [FakeResponse('How old are you?')])
+        for i in range(3):
+            Connection.objects.create(backend=self.connection.backend, identity='555000%s' % i)
+        # already in a session, so left alone
+        self._open_session()
+        router = FakeRouter()
+        # how many prompts had gone out at each checkpoint
+        checkpoints = []
+        job = broadcast(self.trigger, Connection.objects.all(), router, rate=0, batch_size=2,
+                        progress=lambda last_pk: checkpoints.append(len(router.sent)))
+        self.assertEqual((3, 1, 0), (job.started, job.skipped, job.failed))
+        self.assertEqual([1, 3], checkpoints)
+        self.assertEqual(4, XFormsSession.objects.filter(ended=False).count())
+        self.assertEqual(['How old are you?'] * 3, [msg.text for msg in router.sent])
+
+
+    def test_numeric_session_ids(self):
+        # as touchforms numbers them
+        ids = iter(range(100, 200))
+        touchforms_client.start_session = lambda config: \
+            (next(ids), [FakeResponse('How old are you?')])
+        router = FakeRouter()
+        job = broadcast(self.trigger, Connection.objects.all(), router, rate=0)
+        self.assertEqual((1, 0, 0), (job.started, job.skipped, job.failed))
+        self.assertEqual(['How old are you?'], [msg.text for msg in router.sent])
+        self.assertEqual(u'100', XFormsSession.objects.get(connection=self.connection).session_id)
+
+class WholeFormPreValidationTest(SmsFormsTestCase):
+
+    def setUp(self):
+        super(WholeFormPreValidationTest, self).setUp()
+        self.answered = []
+
+        def next_responses(session_id, answer, auth=None):
+            self.answered.append(answer)
+            sms_form_complete.send(sender='touchforms', session_id=session_id, form='<data/>')
+            return [FakeResponse('Thanks!')]
+        touchforms_client.next_responses = next_responses
+
+    def test_rejects_bad_answers_up_front(self):
+        msg = self._message('survey old')
+        self.app.handle(msg)
+        self.assertEqual([], self.answered)
+        self.assertEqual(['Answer must be a number! for "How old are you?"'],
+                         [response.text for response in msg.responses])
+        self.assertTrue(XFormsSession.objects.get(connection=self.connection).ended)
+
+    def test_forms_with_logic_are_left_to_touchforms(self):
+        path = self.trigger.xform.file.path
+        with open(path, 'w') as f:
+            f.write(TEST_XFORM.replace('type="int"', 'type="int" constraint=". > 0"'))
+        # a new mtime, so the definition is parsed again
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.app.handle(self._message('survey old'))
+        self.assertEqual(['old'], self.answered)
+
+
+class LostSessionResponse(object):
+    """
+    What touchforms answers about a session it doesn't have (any more).
+    """
+    is_error = True
+    status = 'http-error'
+    error = 'No session'
+    event = None
+    text_prompt = None
+
+
+class SnapshotTest(SmsFormsTestCase):
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        ids = iter(range(100))
+        touchforms_client.start_session = lambda config: \
+            ('fake-session-%s' % next(ids), [FakeResponse('How old are you?')])
+        self.app.handle(self._message('survey'))
+        self.app.handle(self._message('42'))
+        self.session = XFormsSession.objects.get(connection=self.connection)
+        self.assertEqual([u'42'], session_snapshots.answers(self.session))
+
+        # from now on touchforms doesn't answer about fake-session-0
+        self.answered = []
+
+        def next_responses(session_id, answer, auth=None):
+            if session_id == 'fake-session-0':
+                return [LostSessionResponse()]
+            self.answered.append(answer)
+            return [FakeResponse('Thanks!')]
+        touchforms_client.next_responses = next_responses
+
+    def _touchforms_has_session(self, has_session):
+        touchforms_client.has_session = lambda session_id: has_session
+        self.addCleanup(delattr, touchforms_client, 'has_session')
+
+    def test_rebuilds_lost_session(self):
+        # touchforms restarts and forgets fake-session-0
+        self._touchforms_has_session(False)
+        self.app.handle(self._message('7'))
+        self.assertEqual([u'42', u'7'], self.answered)
+        session = XFormsSession.objects.get(pk=self.session.pk)
+        self.assertEqual('fake-session-1', session.session_id)
+        self.assertEqual([u'42', u'7'], session_snapshots.answers(session))
+
+    def test_leaves_session_when_touchforms_unreachable(self):
+        self._touchforms_has_session(None)
+        self.app.handle(self._message('7'))
+        self.assertEqual([], self.answered)
+        self.assertEqual('fake-session-0', XFormsSession.objects.get(pk=self.session.pk).session_id)
+
+    def test_fails_cleanly_when_touchforms_is_down(self):
+        self._touchforms_has_session(False)
+
+        def start_session(config):
+            raise IOError('Connection refused')
+        touchforms_client.start_session = start_session
+        self.assertFalse(session_snapshots.restore(self.app, self.connection.contact, self.session))
+        self.assertEqual('fake-session-0', XFormsSession.objects.get(pk=self.session.pk).session_id)
+
+    def test_fails_cleanly_when_replay_fails(self):
+        self._touchforms_has_session(False)
+
+        def next_responses(session_id, answer, auth=None):
+            raise IOError('Connection reset')
+        touchforms_client.next_responses = next_responses
+        self.assertFalse(session_snapshots.restore(self.app, self.connection.contact, self.session))
+        self.assertEqual('fake-session-0', XFormsSession.objects.get(pk=self.session.pk).session_id)
@@ -0,0 +1,111 @@
+from urlparse import urlparse
+from rapidsms.conf import settings
+import Queue
+import httplib
+import socket
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TransportError(Exception):
+    pass
+
+
+class ServerError(TransportError):
+    """
+    touchforms was reached but answered with an error status.
+    """
+
+
+class BaseTransport(object):
+    """
+    Sends requests to the touchforms server. Subclasses implement
+    request(), which posts the data dict as JSON and returns the decoded
+    JSON response, raising TransportError if the server can't be reached
+    (ServerError if it answers with an error status).
+    """
+
+    def request(self, data, idempotent=False):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class PooledTransport(BaseTransport):
+    """
+    Posts to touchforms over a pool of keep-alive HTTP connections.
+
+    Failed requests are retried with exponential backoff, but only when
+    it's safe to do so: requests that are idempotent (e.g. fetching the
+    current question) or that failed on a pooled connection the server had
+    already dropped, so can't have been processed.
+    """
+
+    def __init__(self, url=None, pool_size=None, timeout=None, retries=None, backoff=None):
+        parsed = urlparse(url or settings.XFORMS_PLAYER_URL)
+        self.secure = parsed.scheme == 'https'
+        self.netloc = parsed.netloc
+        self.path = parsed.path or '/'
+        self.timeout = timeout or settings.SMSFORMS_TOUCHFORMS_TIMEOUT
+        self.retries = settings.SMSFORMS_TOUCHFORMS_RETRIES if retries is None else retries
+        self.backoff = settings.SMSFORMS_TOUCHFORMS_BACKOFF if backoff is None else backoff
+        self._idle = Queue.LifoQueue(pool_size or settings.SMSFORMS_TOUCHFORMS_POOL_SIZE)
+
+    def _connect(self):
+        cls = httplib.HTTPSConnection if self.secure else httplib.HTTPConnection
+        return cls(self.netloc, timeout=self.timeout)
+
+    def _checkout(self):
+        """
+        Returns an idle connection (and True) or a new one (and False).
+        """
+        try:
+            return self._idle.get_nowait(), True
+        except Queue.Empty:
+            return self._connect(), False
+
+    def _checkin(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def request(self, data, idempotent=False):
+        body = json.dumps(data)
+        headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        attempt = 0
+        while True:
+            conn, reused = self._checkout()
+            try:
+                conn.request('POST', self.path, body, headers)
+                response = conn.getresponse()
+                content = response.read()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                stale = reused and not isinstance(e, socket.timeout)
+                if attempt >= self.retries or not (idempotent or stale):
+                    raise TransportError('Request to touchforms failed: %s' % e)
+                if not stale:
+                    time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+                logger.debug('Retrying touchforms request (attempt %s): %s' % (attempt, e))
+                continue
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(conn)
+            if response.status != 200:
+                raise ServerError('touchforms responded with HTTP %s' % response.status)
+            return json.loads(content)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                return
@@ -0,0 +1,104 @@
+from collections import namedtuple
+from django.core.cache import cache
+from smsforms.models import DecisionTrigger
+import threading
+import hashlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# shared cache key that is bumped whenever a trigger changes so that
+# every worker process knows to rebuild its local index
+VERSION_KEY = 'smsforms:trigger_index:version'
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+# seconds after a change during which processes that don't see it yet
+# keep rebuilding (after that it must have been rolled back)
+SETTLE_TIME = 60
+
+TriggerEntry = namedtuple('TriggerEntry', ['trigger', 'context', 'form_path'])
+
+
+def _entry_for(trigger):
+    return TriggerEntry(trigger=trigger, context=trigger.context,
+                        form_path=trigger.xform.file.path)
+
+
+def _fingerprint(triggers):
+    return hashlib.md5(repr([(t.pk, t.trigger_keyword, t.final_response, t.context_data,
+                              t.xform_id, t.xform.file.name) for t in triggers])).hexdigest()
+
+
+class TriggerIndex(object):
+    """
+    Process-local index of DecisionTriggers keyed by lowercased keyword.
+
+    The index is built lazily from the database and rebuilt whenever the
+    shared version stamp (kept in the django cache) changes, which happens
+    any time a trigger is saved or deleted in any process. The stamp is a
+    fingerprint of the triggers, so a process that rebuilds before the
+    change is committed can tell, and rebuilds again next time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_keyword = None
+        self._by_pk = {}
+        self._version = None
+
+    def invalidate(self):
+        """
+        Has every process rebuild its index. Called while the change is
+        being saved, so the fingerprint is of the triggers as this (not
+        yet committed) transaction sees them.
+        """
+        with self._lock:
+            self._by_keyword = None
+        cache.set(VERSION_KEY, (_fingerprint(self._triggers()), time.time()), VERSION_TIMEOUT)
+
+    def _triggers(self):
+        return list(DecisionTrigger.objects.select_related('xform').order_by('pk'))
+
+    def _build(self, triggers):
+        by_keyword = {}
+        by_pk = {}
+        for trigger in triggers:
+            keyword = trigger.trigger_keyword.lower().strip()
+            entry = _entry_for(trigger)
+            if keyword in by_keyword:
+                logger.warn('Duplicate trigger keyword "%s", ignoring trigger %s' % (keyword, trigger.pk))
+            else:
+                by_keyword[keyword] = entry
+            by_pk[trigger.pk] = entry
+        return by_keyword, by_pk
+
+    def _current(self):
+        version = cache.get(VERSION_KEY)
+        with self._lock:
+            if self._by_keyword is None or version != self._version:
+                triggers = self._triggers()
+                self._by_keyword, self._by_pk = self._build(triggers)
+                self._version = version
+                if version is not None and version[0] != _fingerprint(triggers) and \
+                        time.time() - version[1] < SETTLE_TIME:
+                    # the change isn't committed yet
+                    self._version = None
+            return self._by_keyword, self._by_pk
+
+    def get(self, keyword):
+        """
+        Returns the TriggerEntry for the keyword (case insensitive), or None.
+        """
+        by_keyword, _ = self._current()
+        return by_keyword.get(keyword.lower().strip())
+
+    def entry_for(self, trigger):
+        """
+        Returns the indexed TriggerEntry for a trigger object, falling back
+        to building one on the fly for triggers the index doesn't know about.
+        """
+        _, by_pk = self._current()
+        entry = by_pk.get(trigger.pk)
+        return entry if entry is not None else _entry_for(trigger)
+
+trigger_index = TriggerIndex()
@@ -0,0 +1,10 @@
+from django.utils.importlib import import_module
+
+
+def import_class(path):
+    """
+    Imports a class (or any other attribute) from its dotted path, e.g.
+    'smsforms.sessioncache.LocalSessionCache'.
+    """
+    module, _, name = path.rpartition('.')
+    return getattr(import_module(module), name)
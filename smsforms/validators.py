@@ -0,0 +1,102 @@
+from rapidsms.conf import settings
+from smsforms.lru import LRUCache
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerValidator(object):
+    """
+    Validates and formats answers to a question before they are sent to
+    touchforms. validate() returns a tuple of the formatted answer and an
+    error message (None if the answer is fine).
+    """
+
+    def validate(self, text):
+        return text, None
+
+
+class IntValidator(AnswerValidator):
+
+    def validate(self, text):
+        try:
+            return int(text), None
+        except ValueError:
+            return text, 'Answer must be a number!'
+
+
+class SelectValidator(AnswerValidator):
+    """
+    Prepares multi/single select answers for TouchForms. Options can be
+    given by number or by the text of the choice, and are passed on as
+    numbers.
+    """
+    delimiter = re.compile(settings.MULTISELECT_DELIMITER_RE)
+
+    def __init__(self, choices):
+        self.count = len(choices)
+        self.numbers = {}
+        for i, choice in enumerate(choices):
+            self.numbers.setdefault(choice.lower(), str(i + 1))
+
+    def validate(self, text):
+        if not len(str(text).strip()):
+            return text, None
+        new_answers = []
+        for opt in self.delimiter.split(str(text)):
+            try:
+                # in the case that we accept numbers to indicate option selection
+                opt_int = int(opt)
+            except ValueError:
+                # in the case where we accept the actual text of the question
+                number = self.numbers.get(opt.lower())
+                if number is None:
+                    return text, 'Answer must be one of the choices'
+                new_answers.append(number)
+            else:
+                if not (1 <= opt_int <= self.count):
+                    return text, 'Answer %s must be between 1 and %s' % (opt_int, self.count)
+                new_answers.append(str(opt_int))
+        return ' '.join(new_answers), None
+
+
+_validators = LRUCache(1000)
+
+
+def validator_for(response):
+    """
+    Returns the (cached) validator for the question in a touchforms
+    response. Validators are cached by what they check, the question's
+    datatype and choices, so questions that ask the same thing (within and
+    across forms) share one.
+    """
+    if response.event is None:
+        return _validator(None, None)
+    return _validator(response.event.datatype, response.event.choices)
+
+
+def validator_for_question(question, language=None):
+    """
+    Like validator_for, for a question of a parsed form definition (see
+    formdefs.py), as it is asked in language.
+    """
+    return _validator(question.datatype, question.choice_captions(language))
+
+
+def _validator(datatype, choices):
+    if datatype in ('select', 'multiselect'):
+        key = (datatype, tuple(choices or ()))
+    else:
+        key = (datatype,)
+    validator = _validators.get(key)
+    if validator is None:
+        logger.debug('Compiling validator for %s question' % datatype)
+        if datatype == 'int':
+            validator = IntValidator()
+        elif datatype in ('select', 'multiselect'):
+            validator = SelectValidator(choices or [])
+        else:
+            validator = AnswerValidator()
+        _validators.set(key, validator)
+    return validator
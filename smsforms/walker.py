@@ -0,0 +1,199 @@
+from xml.etree import ElementTree
+from django.core.cache import cache
+from rapidsms.conf import settings
+from touchforms.formplayer.api import XformsResponse
+from touchforms.formplayer.signals import sms_form_complete
+from smsforms.formdefs import form_definitions
+from smsforms.metrics import metrics
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# session ids of the forms played here rather than by touchforms
+LOCAL_PREFIX = 'local-'
+# the question types we know how to check answers for
+LOCAL_DATATYPES = frozenset(['str', 'int', 'longint', 'float', 'select', 'multiselect', 'info'])
+REQUIRED = 'An answer is required'
+
+
+def is_local(session_id):
+    return isinstance(session_id, basestring) and session_id.startswith(LOCAL_PREFIX)
+
+
+def instance_xml(definition, answers):
+    """
+    The form's instance with the answers given so far filled in.
+    """
+    root = ElementTree.fromstring(definition.instance)
+    ns = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+    for question, answer in zip(definition.questions, answers):
+        if answer is None or not question.ref:
+            continue
+        path = '/'.join(ns + part for part in question.ref.strip('/').split('/')[1:])
+        node = root.find(path)
+        if node is not None:
+            node.text = answer
+    return ElementTree.tostring(root)
+
+
+def _event(question, language):
+    return {'type': 'question', 'caption': question.caption(language),
+            'datatype': question.datatype, 'required': int(question.required),
+            'choices': question.choice_captions(language) if question.choices else None}
+
+
+def _validation_error(reason, type='constraint'):
+    return XformsResponse({'status': 'validation-error', 'type': type, 'reason': reason})
+
+
+def _parse_answer(question, answer):
+    """
+    Returns the answer as it goes in the instance (None for blank
+    answers) and an error message (None if the answer is fine).
+    """
+    answer = unicode(answer).strip() if answer is not None else ''
+    if not answer:
+        if question.required and question.datatype != 'info':
+            return None, REQUIRED
+        return None, None
+    if question.datatype in ('int', 'longint'):
+        try:
+            return unicode(int(answer)), None
+        except ValueError:
+            return None, 'Answer must be a number'
+    if question.datatype == 'float':
+        try:
+            return unicode(float(answer)), None
+        except ValueError:
+            return None, 'Answer must be a number'
+    if question.datatype in ('select', 'multiselect'):
+        numbers = answer.split()
+        if question.datatype == 'select' and len(numbers) != 1:
+            return None, 'Only one choice is allowed'
+        values = []
+        for number in numbers:
+            try:
+                number = int(number)
+            except ValueError:
+                number = 0
+            if not 1 <= number <= len(question.choices):
+                return None, 'Answer must be one of the choices'
+            values.append(question.choices[number - 1].value)
+        return ' '.join(values), None
+    if question.datatype == 'info':
+        return None, None
+    return answer, None
+
+
+class LocalFormEngine(object):
+    """
+    Plays simple forms, whose questions follow one another with no XPath
+    logic, without touchforms: questions and answer checks come from the
+    parsed form definition (see formdefs.py), each session's progress is
+    kept in the django cache and the instance is built here. Anything else
+    is left to touchforms.
+
+    Mirrors the TouchformsClient's calls and responses (and raises
+    sms_form_complete the same way), so the app can't tell the difference.
+    """
+    key_prefix = 'smsforms:local-session:'
+
+    def can_play(self, config):
+        definition = form_definitions.get(config.form_path)
+        return definition is not None and not definition.has_logic and \
+            definition.instance is not None and \
+            all(q.datatype in LOCAL_DATATYPES for q in definition.questions)
+
+    def _key(self, session_id):
+        return '%s%s' % (self.key_prefix, session_id)
+
+    def _load(self, session_id):
+        state = cache.get(self._key(session_id))
+        if state is None:
+            logger.error('No local form session %s' % session_id)
+            return None, None
+        return state, form_definitions.get(state['form_path'])
+
+    def _save(self, session_id, state):
+        cache.set(self._key(session_id), state, settings.SMSFORMS_SESSION_TTL)
+
+    def start_session(self, config):
+        definition = form_definitions.get(config.form_path)
+        session_id = '%s%s' % (LOCAL_PREFIX, uuid.uuid4().hex)
+        state = {'form_path': config.form_path, 'index': 0, 'answers': [],
+                 'language': definition.resolve_language(config.language)}
+        metrics.incr('sessions.local')
+        responses = self._play(session_id, state, definition)
+        responses[0].session_id = session_id
+        return session_id, responses
+
+    def _answer(self, state, definition, answer):
+        """
+        Records the answer to the current question, returning a
+        validation error response if it isn't acceptable.
+        """
+        value, error = _parse_answer(definition.questions[state['index']], answer)
+        if error:
+            return _validation_error(error, 'required' if error == REQUIRED else 'constraint')
+        state['answers'].append(value)
+        state['index'] += 1
+
+    def _play(self, session_id, state, definition, info=True):
+        """
+        Moves on to the next question that needs an answer (or to the end
+        of the form), answering info questions on the way unless info is
+        False.
+        """
+        responses = []
+        while True:
+            if state['index'] >= len(definition.questions):
+                output = instance_xml(definition, state['answers'])
+                self.forget(session_id)
+                responses.append(XformsResponse({'event': {'type': 'form-complete',
+                                                           'output': output}}))
+                sms_form_complete.send(sender="touchforms", session_id=session_id, form=output)
+                return responses
+            question = definition.questions[state['index']]
+            responses.append(XformsResponse({'event': _event(question, state['language'])}))
+            if question.datatype != 'info' or not info:
+                self._save(session_id, state)
+                return responses
+            self._answer(state, definition, 'ok')
+
+    def next_responses(self, session_id, answer):
+        state, definition = self._load(session_id)
+        if definition is None:
+            return [XformsResponse.server_down()]
+        error = self._answer(state, definition, answer)
+        if error:
+            return [error]
+        return self._play(session_id, state, definition)
+
+    def answer_question(self, session_id, answer):
+        state, definition = self._load(session_id)
+        if definition is None:
+            return XformsResponse.server_down()
+        return self._answer(state, definition, answer) or \
+            self._play(session_id, state, definition, info=False)[-1]
+
+    def has_session(self, session_id):
+        return cache.get(self._key(session_id)) is not None
+
+    def current_question(self, session_id):
+        state, definition = self._load(session_id)
+        if definition is None:
+            return XformsResponse.server_down()
+        return XformsResponse({'event': _event(definition.questions[state['index']],
+                                               state['language'])})
+
+    def get_raw_instance(self, session_id):
+        state, definition = self._load(session_id)
+        if definition is None:
+            return None
+        return instance_xml(definition, state['answers'])
+
+    def forget(self, session_id):
+        cache.delete(self._key(session_id))
+
+local_forms = LocalFormEngine()
@@ -0,0 +1,180 @@
+import Queue
+import threading
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+_stop = object()
+
+
+class KeyedWorkerPool(object):
+    """
+    Runs jobs on a fixed pool of worker threads.
+
+    Jobs submitted with the same key always go to the same worker, so they
+    are handled in the order they were submitted. Each worker has a bounded
+    queue and submit() blocks while it is full, so producers slow down to
+    the pace of the workers. Workers hand handler up to batch_size queued
+    jobs at a time.
+    """
+
+    def __init__(self, handler, workers, queue_size, batch_size=1, name='smsforms-worker'):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.name = name
+        self._queues = [Queue.Queue(queue_size) for _ in range(workers)]
+        self._threads = []
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    def start(self):
+        if self.running:
+            return
+        for i, queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(queue,),
+                                      name='%s-%s' % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, wait=True):
+        """
+        Stops the workers once they have finished the jobs already queued.
+        """
+        for queue in self._queues:
+            queue.put(_stop)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def submit(self, key, job, timeout=None):
+        """
+        Queues job, waiting up to timeout seconds (forever if None) for
+        room. Raises Queue.Full if there is none.
+        """
+        self._queues[hash(key) % len(self._queues)].put(job, True, timeout)
+
+    def join(self):
+        """
+        Waits until the workers have handled every job queued so far (and
+        any queued while waiting).
+        """
+        for queue in self._queues:
+            queue.join()
+
+    def _work(self, queue):
+        while True:
+            batch = [queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not _stop:
+                try:
+                    batch.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stopping = batch[-1] is _stop
+            if stopping:
+                batch.pop()
+            if batch:
+                try:
+                    self.handler(batch)
+                except Exception:
+                    logger.exception('Error in %s handling %s jobs' % (self.name, len(batch)))
+            for _ in range(len(batch) + stopping):
+                queue.task_done()
+            if stopping:
+                return
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Future(object):
+    """
+    The outcome of a job run by an Executor, available once it's done.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for the job to finish
+        and returns its result, or raises what it raised.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, callback):
+        """
+        Calls callback with the future once it's done (right away if it is).
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception('Error in future callback')
+
+    def set_result(self, result):
+        self._finish(result=result)
+
+    def set_exception(self, exc_info):
+        self._finish(exc_info=exc_info)
+
+
+class Executor(object):
+    """
+    Calls functions on a KeyedWorkerPool, returning a Future for each
+    call. Calls submitted with the same key run in order.
+    """
+
+    def __init__(self, workers, queue_size, name='smsforms-executor'):
+        self._pool = KeyedWorkerPool(self._run, workers, queue_size, name=name)
+
+    @property
+    def running(self):
+        return self._pool.running
+
+    def start(self):
+        self._pool.start()
+
+    def stop(self, wait=True):
+        self._pool.stop(wait)
+
+    def submit(self, key, func, *args, **kwargs):
+        future = Future()
+        self._pool.submit(key, (future, func, args, kwargs))
+        return future
+
+    def _run(self, batch):
+        for future, func, args, kwargs in batch:
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception:
+                logger.exception('Error in %s calling %s' % (self._pool.name, func))
+                future.set_exception(sys.exc_info())